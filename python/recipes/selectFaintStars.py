@@ -10,7 +10,7 @@ Occasionally we might want to avoid simulating bright objects,
 if we want to reduce the time spent drawing photons from a 
 6th magnitude star or we want to avoid too many saturated
 objects. This script ingests an input catalog, uses the 
-utensil getPhosimMag to translate the catalog information 
+utensil getPhosimMags to translate the catalog information 
 into and observed r-band magnitude, and runs on the resulting 
 reduced catalog. 
 
@@ -22,7 +22,6 @@ reduced catalog.
 ## you'll need utensils in your $PYTHONPATH
 import utensils
 import subprocess
-import urllib
 
 # ======================================================================
 
@@ -42,24 +41,27 @@ def selectFaintStars():
     # If phosim is not in your PATH, edit this line to point to it. 
     phosim_path = "/path/to/phosim/installation/" 
 
-    # getPhosimMag need the filter throughput curves. If unspecified, 
-    # getPhosimMag will download it from the website *every time* it's called. 
-    # It will be far more efficient if we download the file, and pass it to the function. 
-    # Possible filters: u g r i z y4
+    # getPhosimMag needs the filter throughput curves. The LSST baseline
+    # curves are read once from the local throughput store (see
+    # utensils.throughputs), which is filled from the LSST trac website on
+    # first use, or offline with "python throughputs.py total_r.dat".
+    # Possible filters: u g r i z y
     
-    urlfile = 'https://dev.lsstcorp.org/trac/export/29728/sims/throughputs/tags/1.2/baseline/total_r.dat'
-    print 'reading throughput curve from {}.'.format(urlfile)
-    urllib.urlretrieve(urlfile, 'total_r.dat')
-        
-    lsst_filter = 'total_r.dat'
+    lsst_filter = 'r'
+
+    # Compute the r-band magnitudes of all the stars in one go. The 
+    # catalog is read in chunks, and the chunks can be spread over several
+    # processes with the processes keyword. 
+    mags = utensils.getPhosimMags(catfile, lsst_filter, sed_dir=path_to_SEDs)
+    mags = mags[lsst_filter]
 
     ## Open the file we'll write the output into.
     newcatfilename = "faint-msstars.pars"
     newcatfile = open(newcatfilename,"w")
 
+    iobj = 0
     for line in open(catfile):
-        cols = line.split()
-        if len(cols)<3:
+        if not line.startswith('object'):
             # these are the params that set up the observation. 
             print >> newcatfile, line[:-1]
 
@@ -68,17 +70,9 @@ def selectFaintStars():
             # name  id  ra  dec  mag_norm  sed  redshift shear1 shear2 magnification shift_x shift_y  source_type  dust_model_in_rest_frame  internal_ac  internal_rv  dust_model_lab_frame  galactic_av galt=ctic_rv 
             # Stars, of course, have zeros for the shear/magnification/shift parameters, and for the galactic dust model. 
 
-            # getPhosimMag requires the filter, mag_norm, sed name, and internal dust params.
-
-            mag_norm = float(cols[4])
-            sed = path_to_SEDs+cols[5]
-            redshift = float(cols[6])
-            int_dust = cols[13]
-            int_Av = float(cols[14])
-            int_Rv = float(cols[15])
-            
-            # Run the utensil to obtain the r-band magnitudes
-            mag = utensils.getPhosimMag(lsst_filter, mag_norm, sed, redshift, int_dust, int_Av, int_Rv)
+            # getPhosimMags returns the magnitudes in catalog order.
+            mag = mags[iobj]
+            iobj += 1
             # Let's discard all stars brighter than 16th mag (which is roughly when saturation occurs in an LSST CCD)
             if mag<16:
                 continue
@@ -5,5 +5,5 @@ from persistence import makedir
 del persistence
 from knife_kit import PhosimParameters
 del knife_kit
-from getPhosimMag import getPhosimMag
+from getPhosimMag import getPhosimMag, getPhosimMags
 
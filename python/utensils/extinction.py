@@ -28,8 +28,17 @@
 """Extinction law functions."""
 
 from __future__ import division
+import hashlib
 import numpy as np
 import warnings
+try:
+    from collections import OrderedDict
+except ImportError:
+    from OrderedDict import OrderedDict
+
+# Maximum number of curves kept by unit_extinction.
+unit_cache_size = 256
+_unit_cache = OrderedDict()
 
 def extinction(wave, ebv=None, a_v=None, r_v=3.1, model='f99'):
     """Return extinction in magnitudes at given wavelength(s).
@@ -315,6 +324,96 @@ def reddening(wave, ebv=None, a_v=None, r_v=3.1, model='od94'):
 
     return 10**(0.4 * extinction(wave, ebv=ebv, a_v=a_v, r_v=r_v, model=model))
 
+def unit_extinction(wave, r_v=3.1, model='f99'):
+    """Return the extinction curve for A(V) = 1, memoized.
+
+    Parameters
+    ----------
+    wave : list_like
+        Wavelengths in Angstroms.
+    r_v : float, optional
+        R_V parameter. Default is 3.1.
+    model : {'ccm89', 'od94', 'gcc09', 'f99', 'fm07'}, optional
+        See `extinction`.
+
+    Returns
+    -------
+    extinction : `~numpy.ndarray`
+        Read-only array of A(lambda)/A(V).
+
+    Notes
+    -----
+    The extinction scales linearly with A(V), so the curve for any
+    A(V) is ``a_v * unit_extinction(wave, r_v, model)``. The most
+    recently used ``unit_cache_size`` curves are kept, keyed by the
+    model, R_V and a hash of the wavelength grid, so that objects
+    sharing an SED grid only pay for the model evaluation once.
+    """
+    wave = np.ascontiguousarray(wave, dtype=float)
+    key = (model.lower(), float(r_v), wave.shape,
+           hashlib.sha1(wave).hexdigest())
+    try:
+        curve = _unit_cache.pop(key)
+    except KeyError:
+        curve = np.atleast_1d(extinction(wave, a_v=1., r_v=r_v, model=model))
+        curve.flags.writeable = False
+        if len(_unit_cache) >= unit_cache_size:
+            _unit_cache.popitem(last=False)
+    _unit_cache[key] = curve
+    return curve
+
+def extinction_batch(wave, a_v, r_v=3.1, model='f99'):
+    """Return extinction in magnitudes for many objects at once.
+
+    Parameters
+    ----------
+    wave : list_like
+        Wavelengths in Angstroms, shared by all objects.
+    a_v : list_like
+        A(V) total V band extinction of each object, in magnitudes.
+    r_v : float or list_like, optional
+        R_V parameter, either one value for all objects or one per
+        object. Default is 3.1.
+    model : {'ccm89', 'od94', 'gcc09', 'f99', 'fm07'}, optional
+        See `extinction`.
+
+    Returns
+    -------
+    extinction : `~numpy.ndarray`
+        Extinction in magnitudes with shape (n_objects, n_wave).
+
+    Notes
+    -----
+    Since the extinction is linear in A(V), the curve for A(V) = 1 is
+    computed once for each distinct value of R_V and scaled for every
+    object sharing it.
+
+    Examples
+    --------
+
+    >>> wave = np.array([2000., 2500., 3000.])
+    >>> extinction_batch(wave, a_v=[0., 0.5, 1.], r_v=3.1)[2]
+    array([ 2.76225609,  2.27590036,  1.79956381])
+
+    """
+    a_v, r_v = np.broadcast_arrays(np.atleast_1d(np.asarray(a_v, dtype=float)),
+                                   np.asarray(r_v, dtype=float))
+    wave = np.atleast_1d(wave)
+    unique_r_v, inverse = np.unique(r_v, return_inverse=True)
+    unit_curves = np.array([unit_extinction(wave, r_v=x, model=model)
+                            for x in unique_r_v]).reshape(-1, len(wave))
+    return a_v[:, np.newaxis] * unit_curves[inverse]
+
+def reddening_batch(wave, a_v, r_v=3.1, model='od94'):
+    """Return reddening for many objects at once.
+
+    Same as `reddening`, with the same default model, but for arrays
+    of per-object A(V) (and optionally R_V), returning an array of
+    shape (n_objects, n_wave). See `extinction_batch`, whose default
+    model, like that of `extinction`, is 'f99'.
+    """
+    return 10**(0.4 * extinction_batch(wave, a_v, r_v=r_v, model=model))
+
 def _gcc09(x, ebv, r_v):
     f_a = np.zeros_like(x)
     f_b = np.zeros_like(x)
@@ -382,6 +481,9 @@ def _ccm89_like(x, ebv, r_v, optical_coeffs_a, optical_coeffs_b):
 
     return ebv * (r_v * a + b)
 
+# Optical/IR splines of the f99 and fm07 models, keyed by (model, r_v).
+_oir_splines = {}
+
 def _f99_like(x, ebv, r_v, model='f99'):
     from scipy.interpolate import interp1d
 
@@ -459,7 +561,15 @@ def _f99_like(x, ebv, r_v, model='f99'):
     # Note that interp1d requires that the input abscissa is monotonically
     # _increasing_. This is opposite the usual ordering of a spectrum, but
     # fortunately the _output_ abscissa does not have the same requirement.
-    oir_spline = interp1d(anchors_x, anchors_k, kind='cubic')
+    # The spline only depends on the model and R_V, so keep it around
+    # for the next call.
+    key = (model, float(r_v))
+    oir_spline = _oir_splines.get(key)
+    if oir_spline is None:
+        if len(_oir_splines) >= 256:
+            _oir_splines.clear()
+        oir_spline = interp1d(anchors_x, anchors_k, kind='cubic')
+        _oir_splines[key] = oir_spline
     k[oir_region] = oir_spline(y)
 
     return ebv * (k + r_v)
@@ -43,12 +43,26 @@
 import os
 import subprocess
 import sys, glob, optparse, shutil
+import collections
+import contextlib
 import distutils.spawn
+import errno
+import functools
+import gzip
+import json
+import math
 import multiprocessing
+from multiprocessing.pool import ThreadPool
+import tempfile
+import threading
+import time
+import traceback
 try:
     from collections import OrderedDict
 except ImportError:
     from OrderedDict import OrderedDict
+import filecache
+import jobqueue
 
 _opsim_mapping = OrderedDict([
         ("Opsim_moonra", "moonra"),
@@ -85,6 +99,16 @@ _opsim_mapping = OrderedDict([
         ("SIM_ACTUATOR", "actuator")
         ])
 
+# Parameters that only locate files; they are left out of the cache
+# keys so that runs in different directories can share outputs.
+_path_keys = ('seddir', 'imagedir', 'datadir', 'instrdir', 'bindir',
+              'flatdir')
+
+# Parameters used only by the atmosphere program (sky background and
+# dome light), which are left out of the instrument cache key.
+_atmosphere_keys = ('moonra', 'moondec', 'solaralt', 'moonalt', 'moondist',
+                    'phaseang', 'constrainseeing', 'domelight', 'domewave')
+
 def _cast(value):
     """
     Cast input strings to their 'natural' types.  Strip single quotes
@@ -111,50 +135,666 @@ def parse_params(lines):
         output[tokens[0]] = _cast(' '.join(tokens[1:]))
     return output
 
+class Tracer(object):
+    """
+    Collects timed spans as Chrome trace-event JSON ("X" events with
+    microsecond timestamps), which can be loaded into chrome://tracing
+    or Perfetto to view a whole visit on one timeline.  Nothing is
+    recorded unless enabled is True.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Record the time spent in a with block, with its args."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                self.events.append({'name': name, 'ph': 'X',
+                                    'ts': int(start*1e6),
+                                    'dur': int((time.time() - start)*1e6),
+                                    'pid': os.getpid(),
+                                    'tid': threading.current_thread().ident,
+                                    'args': args})
+    def take(self):
+        """Remove and return the events recorded so far."""
+        events, self.events = self.events, []
+        return events
+    def write(self, filename):
+        output = open(filename, 'w')
+        json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'},
+                  output)
+        output.close()
+
+tracer = Tracer()
+
+def traced(name):
+    """Decorator recording every call of a function as a trace span."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
 def jobChip(observationID, cid, eid, filt, outputDir, binDir, 
             instrDir, instrument='lsst', run_e2adc=True,
-            cleanup=False):
+            cleanup=False, compress_level=6, compress_threads=4,
+            direct_output=True, raytrace_input=None, e2adc_input=None):
     """
-    Run an individual chip for a single exposure.
+    Run an individual chip for a single exposure and return the
+    paths of its output images.  The raytrace and
+    e2adc parameters are read from the raytrace_<fid>.pars and
+    e2adc_<fid>.pars files, or are streamed to the programs from the
+    raytrace_input and e2adc_input fragment lists (see runProgram).
+    The images are gzipped in-process by compress_threads threads
+    and, if direct_output is True, written straight to their final
+    names in outputDir.
     """
     fid = '_'.join((observationID, cid, eid))
     segfile = os.path.join(instrDir, 'segmentation.txt')
-    runProgram("raytrace < raytrace_"+fid+".pars", binDir)
-    runProgram("gzip -f "+instrument+"_e_"+fid+".fits")
+    tags = {'chip': cid, 'exposure': eid}
+    with tracer.span('raytrace', chip=cid, exposure=eid):
+        if raytrace_input is None:
+            runProgram("raytrace < raytrace_"+fid+".pars", binDir,
+                       tags=tags)
+        else:
+            runProgram("raytrace", binDir, stdin=raytrace_input, tags=tags)
     if cleanup:
         removeFile('raytrace_'+fid+'.pars')
+    eImage = instrument+'_e_'+fid+'.fits'
+    eImage_basename = '%s_e_%s_f%s_%s_%s.fits.gz' % \
+        (instrument, observationID, filt, cid, eid)
+    eImageRename = os.path.join(outputDir, eImage_basename)
+    # (image, final name) pairs
+    images = []
     if run_e2adc:
-        runProgram("e2adc < e2adc_"+fid+".pars", binDir)
+        # e2adc reads the gzipped electron image from the work directory.
+        with tracer.span('compress', chip=cid, exposure=eid, file=eImage):
+            compressFile(eImage, compress_level=compress_level)
+        with tracer.span('e2adc', chip=cid, exposure=eid):
+            if e2adc_input is None:
+                runProgram("e2adc < e2adc_"+fid+".pars", binDir, tags=tags)
+            else:
+                runProgram("e2adc", binDir, stdin=e2adc_input, tags=tags)
         if cleanup:
             removeFile('e2adc_'+fid+'.pars')
-        for line in open(segfile):
-            aid = line.split()[0]
-            if cid in line and aid != cid:
-                rawImage = instrument+'_a_'+observationID+'_'+aid+'_'+eid+'.fits'
-                runProgram("gzip -f " + rawImage)
-                rawImage_basename = '%s_a_%s_f%s_%s_%s.fits.gz' % \
-                    (instrument, observationID, filt, aid, eid)
-                rawImageRename = os.path.join(outputDir, rawImage_basename)
+        for aid in amplifiers(segfile, cid):
+            rawImage = instrument+'_a_'+observationID+'_'+aid+'_'+eid+'.fits'
+            rawImage_basename = '%s_a_%s_f%s_%s_%s.fits.gz' % \
+                (instrument, observationID, filt, aid, eid)
+            images.append((rawImage, os.path.join(outputDir, rawImage_basename)))
+    else:
+        images.append((eImage, eImageRename))
+        eImage = None
+
+    def compress(image):
+        rawImage, rawImageRename = image
+        with tracer.span('compress', chip=cid, exposure=eid, file=rawImage):
+            if direct_output:
+                compressFile(rawImage, rawImageRename, compress_level)
+            else:
+                compressFile(rawImage, compress_level=compress_level)
+        if not direct_output:
+            with tracer.span('move', chip=cid, exposure=eid, file=rawImage):
                 shutil.move(rawImage+'.gz', rawImageRename)
-    eImage = instrument+'_e_'+observationID+'_'+cid+'_'+eid+'.fits.gz'
-    eImage_basename = '%s_e_%s_f%s_%s_%s.fits.gz' % \
-        (instrument, observationID, filt, cid, eid)
-    eImageRename = os.path.join(outputDir, eImage_basename)
-    shutil.move(eImage, eImageRename)
+    pool = ThreadPool(max(1, min(compress_threads, len(images))))
+    try:
+        pool.map(compress, images)
+    finally:
+        pool.close()
+        pool.join()
+    if eImage is not None:
+        with tracer.span('move', chip=cid, exposure=eid, file=eImage):
+            shutil.move(eImage+'.gz', eImageRename)
+    outputs = [x[1] for x in images]
+    if eImageRename not in outputs:
+        outputs.insert(0, eImageRename)
+    return outputs
+
+def jobTrim(inputParams, binDir, chips=()):
+    """
+    Run trim for one group of chips.
+    """
+    with tracer.span('trim', group=inputParams, chips=' '.join(chips)):
+        # Label the usage by trim group.
+        group = os.path.splitext(inputParams)[0].split('_')[-1]
+        runProgram("trim < "+inputParams, binDir,
+                   tags={'chip': 'group'+group})
+    removeFile(inputParams)
+
+def _runJob(name, target, args, kwargs):
+    """
+    Run a JobPool job in a worker process, returning its name, whether
+    it succeeded, its return value or the formatted traceback, and
+    its trace events and resource usage records.
+    """
+    # Drop any records inherited from the parent process.
+    tracer.take()
+    accounting.take()
+    try:
+        value = target(*args, **kwargs)
+        succeeded = True
+    except Exception:
+        value = traceback.format_exc()
+        succeeded = False
+    return name, succeeded, value, tracer.take(), accounting.take()
+
+def _runJobProcess(connection, name, target, args, kwargs):
+    """Run a JobPool job and send its result to the parent process."""
+    connection.send(_runJob(name, target, args, kwargs))
+    connection.close()
+
+class JobPool(object):
+    """
+    A bounded pool of worker processes.  Each job is started as soon
+    as a worker becomes free, rather than in batches, and completions
+    and failures are reported as they happen.  Completions are handled
+    (and job callbacks run) in the process that calls join or wait.
+    A job whose process dies without a result, e.g., because it was
+    killed for running out of memory, fails.
+    """
+    def __init__(self, numproc=1, stream=sys.stdout, poll=0.1):
+        self.numproc = numproc
+        self.stream = stream
+        self.poll = poll
+        self.njobs = 0
+        self.ndone = 0
+        self.failures = []
+        self.callbacks = {}
+        # Jobs waiting for a free worker
+        self.queued = collections.deque()
+        # (process, connection, name) of the running jobs, by job id
+        self.running = {}
+    def submit(self, name, target, args=(), kwargs=None, callback=None,
+               errback=None):
+        """
+        Queue target(*args, **kwargs) under the label name and return
+        its job id.  If the job succeeds, callback is called with its
+        return value, otherwise errback is called with the traceback.
+        """
+        if kwargs is None:
+            kwargs = {}
+        jobid = self.njobs
+        self.njobs += 1
+        self.callbacks[jobid] = (callback, errback)
+        self.queued.append((jobid, name, target, args, kwargs))
+        self._start()
+        return jobid
+    def _start(self):
+        """Start queued jobs while there are free workers."""
+        while self.queued and len(self.running) < self.numproc:
+            jobid, name, target, args, kwargs = self.queued.popleft()
+            receiver, sender = multiprocessing.Pipe(False)
+            # Use a fresh process for each job.
+            process = multiprocessing.Process(target=_runJobProcess,
+                                              args=(sender, name, target,
+                                                    args, kwargs))
+            process.start()
+            sender.close()
+            self.running[jobid] = (process, receiver, name)
+    def _next(self):
+        """Wait for the next job to finish and return its result."""
+        while True:
+            for jobid, (process, receiver, name) in self.running.items():
+                # Check for the result again after the process has
+                # exited, since it may have been sent meanwhile.
+                alive = process.is_alive()
+                try:
+                    if receiver.poll():
+                        result = receiver.recv()
+                    elif alive:
+                        continue
+                    else:
+                        raise EOFError
+                except (EOFError, IOError):
+                    process.join()
+                    if process.exitcode < 0:
+                        reason = 'killed by signal %d' % -process.exitcode
+                    else:
+                        reason = 'exited with code %d' % process.exitcode
+                    result = (name, False,
+                              'Worker process %s without a result\n'
+                              % reason, [], [])
+                receiver.close()
+                process.join()
+                del self.running[jobid]
+                self._start()
+                return jobid, result
+            time.sleep(self.poll)
+    def _done(self):
+        jobid, (name, succeeded, value, events, usage) = self._next()
+        self.ndone += 1
+        tracer.events.extend(events)
+        accounting.records.extend(usage)
+        callbacks = self.callbacks.pop(jobid)
+        if succeeded:
+            self.stream.write('%s finished (%d of %d submitted jobs done)\n'
+                              % (name, self.ndone, self.njobs))
+        else:
+            self.failures.append(name)
+            self.stream.write('%s failed (%d of %d submitted jobs done):\n%s'
+                              % (name, self.ndone, self.njobs, value))
+        self.stream.flush()
+        callback, errback = callbacks
+        if succeeded and callback is not None:
+            callback(value)
+        elif not succeeded and errback is not None:
+            errback(value)
+        return jobid, name, succeeded
+    def join(self, jobids=None):
+        """
+        Wait for the given jobs (by default, all of the jobs submitted
+        so far, including any submitted by callbacks) to finish and
+        return the names of those that failed.
+        """
+        failures = []
+        while self.callbacks:
+            if (jobids is not None and
+                not [x for x in jobids if x in self.callbacks]):
+                break
+            jobid, name, succeeded = self._done()
+            if not succeeded and (jobids is None or jobid in jobids):
+                failures.append(name)
+        return failures
+    def wait(self):
+        """
+        Wait for all submitted jobs to finish, raising a RuntimeError
+        if any of them failed.
+        """
+        self.join()
+        self.close()
+        if self.failures:
+            raise RuntimeError('%d of %d jobs failed: %s'
+                               % (len(self.failures), self.njobs,
+                                  ', '.join(self.failures)))
+    def close(self):
+        for process, receiver, name in self.running.values():
+            process.join()
+
+# Functions that may be run by JobQueue workers, by name.
+_queueTargets = {'jobChip': jobChip, 'jobTrim': jobTrim}
+
+def _runQueuedJob(descriptor):
+    """
+    Run a job from a JobQueue descriptor written by QueuePool,
+    returning whether it succeeded and its value, trace events and
+    resource usage records.
+    """
+    os.chdir(descriptor['cwd'])
+    tracer.enabled = descriptor.get('trace', False)
+    name, succeeded, value, events, usage = \
+        _runJob(descriptor['name'], _queueTargets[descriptor['target']],
+                descriptor['args'], descriptor['kwargs'])
+    return succeeded, {'value': value, 'events': events, 'usage': usage}
+
+def _serveQueue(queueDir, idle_timeout=None, stop=None):
+    jobqueue.runWorker(jobqueue.JobQueue(queueDir), _runQueuedJob,
+                       idle_timeout=idle_timeout, stop=stop)
+
+def runWorkers(queueDir, numproc=1, idle_timeout=None):
+    """
+    Run numproc workers on this host for the JobQueue in queueDir
+    until it is closed or, if idle_timeout is given, until they have
+    been idle for that many seconds.
+    """
+    workers = [multiprocessing.Process(target=_serveQueue,
+                                       args=(queueDir, idle_timeout))
+               for i in range(numproc)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
 
-def runProgram(command, binDir=None, argstring=None):
+class QueuePool(JobPool):
     """
-    Calls each of the phosim programs using subprocess.call. It raises
-    an exception and aborts if the return code is non-zero.
+    A JobPool whose jobs are written to a JobQueue on a shared
+    filesystem and run by workers on any number of hosts (see
+    runWorkers).  numproc of the workers are run on this host.  Jobs
+    claimed by workers that stop responding for stale_timeout seconds
+    are returned to the queue.
+    """
+    def __init__(self, queueDir, numproc=0, stream=sys.stdout, poll=1.,
+                 stale_timeout=600.):
+        self.queue = jobqueue.JobQueue(queueDir)
+        self.stream = stream
+        self.poll = poll
+        self.stale_timeout = stale_timeout
+        self.njobs = 0
+        self.ndone = 0
+        self.failures = []
+        self.callbacks = {}
+        # Queue names of the unfinished jobs, by job id
+        self.names = {}
+        self.stop = multiprocessing.Event()
+        self.workers = [multiprocessing.Process(target=_serveQueue,
+                                                args=(queueDir, None,
+                                                      self.stop))
+                        for i in range(numproc)]
+        for worker in self.workers:
+            worker.start()
+    def submit(self, name, target, args=(), kwargs=None, callback=None,
+               errback=None):
+        if kwargs is None:
+            kwargs = {}
+        jobid = self.njobs
+        self.njobs += 1
+        self.callbacks[jobid] = (callback, errback)
+        # The workers claim the jobs in the order of their names.
+        self.names[jobid] = '%06d_%s' % (jobid, name.replace(' ', '_'))
+        self.queue.put(self.names[jobid],
+                       {'name': name, 'target': target.__name__,
+                        'args': list(args), 'kwargs': kwargs,
+                        'cwd': os.getcwd(), 'trace': tracer.enabled})
+        return jobid
+    def _next(self):
+        while True:
+            finished = self.queue.finished()
+            for jobid, qname in self.names.items():
+                if qname not in finished:
+                    continue
+                finishedJob = self.queue.result(qname)
+                if finishedJob is None:
+                    # The result file went away after it was listed,
+                    # e.g., while a worker renames it into place.
+                    # Try again on the next poll.
+                    continue
+                state, record = finishedJob
+                del self.names[jobid]
+                result = record['result']
+                if 'error' in result:
+                    # The worker could not run the job.
+                    return jobid, (record.get('name', qname), False,
+                                   result['error'] + '\n', [], [])
+                return jobid, (record['name'], state == 'done',
+                               result['value'], result['events'],
+                               result['usage'])
+            for qname in self.queue.requeueStale(self.stale_timeout):
+                self.stream.write('Requeued %s from an unresponsive worker\n'
+                                  % qname)
+            time.sleep(self.poll)
+    def close(self):
+        """Stop the workers on this host once the queue is empty."""
+        self.stop.set()
+        for worker in self.workers:
+            worker.join()
+
+class JobManifest(object):
+    """
+    Record of the chip jobs of a visit, kept as a JSON file so that an
+    interrupted run can be resumed.  Each job (by chip x exposure ID)
+    has the digest of its inputs (if recorded), its state
+    ('submitted', 'done' or 'failed') and the sizes of its output
+    files.  The file is rewritten after every save_every updates or
+    save_interval seconds, and by save().
+    """
+    def __init__(self, filename, save_every=50, save_interval=30.):
+        self.filename = filename
+        self.save_every = save_every
+        self.save_interval = save_interval
+        self.unsaved = 0
+        self.saved = time.time()
+        self.jobs = {}
+        if os.path.exists(filename):
+            self.jobs = json.load(open(filename))['jobs']
+    def isDone(self, fid, inputs):
+        """
+        True if the job finished with the same inputs and all of its
+        outputs are still present with their recorded sizes.
+        """
+        job = self.jobs.get(fid)
+        if (job is None or job['state'] != 'done' or
+            job.get('inputs') != inputs):
+            return False
+        outputDir = os.path.dirname(self.filename)
+        for name, size in job['outputs'].items():
+            path = os.path.join(outputDir, name)
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                return False
+        return True
+    def update(self, fid, state, inputs=None, outputs=None):
+        """
+        Set the state of a job, with its inputs or outputs.  A
+        submitted job's earlier record is discarded.
+        """
+        if state == 'submitted':
+            self.jobs[fid] = {}
+        job = self.jobs.setdefault(fid, {})
+        job['state'] = state
+        if inputs is not None:
+            job['inputs'] = inputs
+        if outputs is not None:
+            job['outputs'] = dict((os.path.basename(x), os.path.getsize(x))
+                                  for x in outputs)
+        self.unsaved += 1
+        if (self.unsaved >= self.save_every or
+            time.time() - self.saved >= self.save_interval):
+            self.save()
+    def save(self):
+        """Write the manifest atomically."""
+        tmpfile = self.filename + '.tmp'
+        output = open(tmpfile, 'w')
+        json.dump({'jobs': self.jobs}, output, indent=1, sort_keys=True)
+        output.close()
+        os.rename(tmpfile, self.filename)
+        self.unsaved = 0
+        self.saved = time.time()
+
+def runProgram(command, binDir=None, argstring=None, stdin=None,
+               tags=None):
+    """
+    Calls each of the phosim programs using subprocess. It raises an
+    exception and aborts if the return code is non-zero.  If stdin is
+    given, it is a list of ('text', string) and ('file', filename)
+    fragments that are written, in order, to the program's stdin.
+    The program's resource usage is recorded in accounting, along
+    with tags such as the chip and exposure IDs.
     """
     myCommand = command
     if binDir is not None:
         myCommand = os.path.join(binDir, command)
     if argstring is not None:
         myCommand += argstring
-    if subprocess.call(myCommand, shell=True) != 0:
+    start = time.time()
+    inputError = None
+    if stdin is None:
+        process = subprocess.Popen(myCommand, shell=True)
+    else:
+        process = subprocess.Popen(myCommand, shell=True,
+                                   stdin=subprocess.PIPE)
+        try:
+            copyParams(process.stdin, stdin)
+        except IOError as eobj:
+            # A broken pipe means that the program exited without
+            # reading all of its input, and its return code tells
+            # whether that is an error.  Other errors, e.g., a missing
+            # parameter file, are raised once the program has exited.
+            if eobj.errno != errno.EPIPE:
+                inputError = eobj
+        finally:
+            # Closing stdin lets the program see the end of its input.
+            try:
+                process.stdin.close()
+            except IOError:
+                pass
+    # wait4 rather than wait, to get the child's resource usage.
+    while True:
+        try:
+            pid, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError as eobj:
+            if eobj.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    process.returncode = returncode
+    accounting.record(os.path.basename(command.split()[0]),
+                      time.time() - start, rusage, tags)
+    if inputError is not None:
+        raise inputError
+    if returncode != 0:
         raise RuntimeError("Error running %s" % myCommand)
 
+class ResourceUsage(object):
+    """
+    Resource usage of the programs run by runProgram: wall time, user
+    and system CPU time, peak resident set size and block I/O, as
+    reported by wait4.  The records from the JobPool workers are
+    merged into the parent's.
+    """
+    columns = ('wall', 'utime', 'stime', 'maxrss', 'inblock', 'oublock')
+    def __init__(self):
+        self.records = []
+    def record(self, program, wall, rusage, tags=None):
+        entry = {'program': program, 'wall': wall,
+                 'utime': rusage.ru_utime, 'stime': rusage.ru_stime,
+                 # ru_maxrss is in kilobytes on Linux.
+                 'maxrss': rusage.ru_maxrss*1024,
+                 'inblock': rusage.ru_inblock,
+                 'oublock': rusage.ru_oublock}
+        if tags:
+            entry.update(tags)
+        self.records.append(entry)
+    def take(self):
+        """Remove and return the records so far."""
+        records, self.records = self.records, []
+        return records
+    def summary(self):
+        """
+        A table of the usage by program and chip, with totals for each
+        program.  Times and block counts are summed, and the peak RSS
+        is the maximum.
+        """
+        programs = OrderedDict()
+        for entry in sorted(self.records,
+                            key=lambda x: (x['program'], x.get('chip', '-'))):
+            chips = programs.setdefault(entry['program'], OrderedDict())
+            chips.setdefault(entry.get('chip', '-'), []).append(entry)
+        rows = []
+        for program, chips in programs.items():
+            rows.extend((program, chip, entries)
+                        for chip, entries in chips.items())
+            if len(chips) > 1:
+                rows.append((program, 'all', sum(chips.values(), [])))
+        lines = ['%-12s %-12s %5s %10s %10s %10s %11s %10s %10s'
+                 % ('program', 'chip', 'runs', 'wall[s]', 'user[s]',
+                    'sys[s]', 'maxrss[MB]', 'inblock', 'oublock')]
+        for program, chip, entries in rows:
+            total = dict((column, sum(x[column] for x in entries))
+                         for column in self.columns)
+            lines.append('%-12s %-12s %5d %10.2f %10.2f %10.2f %11.1f %10d %10d'
+                         % (program, chip, len(entries), total['wall'],
+                            total['utime'], total['stime'],
+                            max(x['maxrss'] for x in entries)/1024.**2,
+                            total['inblock'], total['oublock']))
+        return '\n'.join(lines) + '\n'
+
+accounting = ResourceUsage()
+
+def copyParams(output, fragments):
+    """
+    Write a list of ('text', string) and ('file', filename) parameter
+    fragments to an open file.
+    """
+    for kind, value in fragments:
+        if kind == 'text':
+            output.write(value)
+        else:
+            input = open(value, 'rb')
+            shutil.copyfileobj(input, output, 1 << 20)
+            input.close()
+
+def writeParams(filename, fragments):
+    """Write a list of parameter fragments to a file."""
+    output = open(filename, 'w')
+    copyParams(output, fragments)
+    output.close()
+
+def catalogCost(filename):
+    """
+    Estimate the raytrace cost of a trimmed catalog.  Returns the
+    number of sources and their summed flux, sum(10**(-0.4*mag_norm)).
+    """
+    nlines=0
+    flux=0.
+    for line in open(filename):
+        nlines+=1
+        tokens=line.split()
+        if tokens and tokens[0]=='object':
+            try:
+                flux+=10**(-0.4*float(tokens[4]))
+            except (IndexError, ValueError):
+                pass
+    # Discount the two header lines written by trim.
+    return nlines-2, flux
+
+_segmentation = {}
+
+def amplifiers(segfile, cid):
+    """
+    The amplifier IDs of a chip, from the instrument's
+    segmentation.txt file, which is only read once per process.
+    """
+    if segfile not in _segmentation:
+        _segmentation[segfile] = open(segfile).readlines()
+    aids = []
+    for line in _segmentation[segfile]:
+        aid = line.split()[0]
+        if cid in line and aid != cid:
+            aids.append(aid)
+    return aids
+
+def compressFile(filename, outfile=None, compress_level=6):
+    """
+    gzip a file in-process, removing the original as 'gzip -f' does.
+    outfile defaults to filename+'.gz'.  The output is written to a
+    temporary name and then renamed, so that a partial file is never
+    left under the final name.
+    """
+    if outfile is None:
+        outfile = filename + '.gz'
+    tmpfile = outfile + '.tmp'
+    input = open(filename, 'rb')
+    output = open(tmpfile, 'wb')
+    zfile = gzip.GzipFile(os.path.basename(filename), 'wb', compress_level,
+                          output)
+    shutil.copyfileobj(input, zfile, 1 << 20)
+    zfile.close()
+    output.close()
+    input.close()
+    os.rename(tmpfile, outfile)
+    os.remove(filename)
+    return outfile
+
+# Typical length in bytes of an object line, and compression ratio
+# of a gzipped catalog, for estimating the number of objects in an
+# includeobj catalog from its size.
+_objectLineBytes = 100
+_gzipRatio = 4
+
+# Catalogs with fewer objects are trimmed in groups of 9 chips even
+# when running in parallel.  trim spends about as long starting up
+# and reading its parameters as reading a catalog of this size, so
+# splitting a smaller catalog into one group per worker multiplies
+# the start-up cost without shortening the groups.
+_splitTrimObjects = 10000
+
+def estimateObjects(filename):
+    """
+    Estimate the number of objects in a (possibly gzipped) catalog
+    file from its size, without reading it.
+    """
+    size=os.path.getsize(filename)
+    if filename.endswith('.gz'):
+        size*=_gzipRatio
+    return size//_objectLineBytes
+
 def removeFile(filename):
     """
     Deletes files.  If any file does not exist, it will catch the
@@ -203,15 +843,54 @@ class PhosimFocalplane(object):
     focalplane.doPreproc(instanceCatalog, extraCommands, sensor)
     focalplane.scheduleRaytrace(instrument, run_e2adc, keep_screens)
     focalplane.cleanup(keep_screens)
+
+    For grids 'no' and 'cluster', the raytracing of each group of
+    chips can instead start as soon as that group has been trimmed:
+
+    focalplane.startRaytrace(instrument, run_e2adc)
+    focalplane.trimObjects(sensor, callback=focalplane.scheduleChips)
+    focalplane.finishRaytrace(keep_screens)
     """
     def __init__(self, phosimDir, opt, grid_opts={}):
         """
         grid:      'no', 'condor', 'cluster'
         grid_opts: A dictionary to supply grid options.  Exactly which options
         depends on the value of 'grid':
-        'no':      'numproc' = Number of threads used to execute raytrace.
+        'no':      'numproc' = Number of worker processes used to execute
+                   raytrace.  A new chip job is started as soon as one
+                   finishes.
+                   'ordering' = 'layout' (default) to submit the chip
+                   jobs in focal plane order, or 'cost' to submit the
+                   most expensive ones (by trimmed catalog flux and
+                   source count) first.  Also applies to 'cluster'.
+                   'trim_group' = Number of chips per trim job, which
+                   also run in the worker pool.  By default, this is
+                   chosen from the catalog size and 'numproc'.  Also
+                   applies to 'cluster'.
+                   'compress_level', 'compress_threads', 'direct_output'
+                   = Image compression options passed to jobChip.
+                   'write_pars' = Write the raytrace & e2adc parameter
+                   files, for debugging, instead of streaming the
+                   parameters to the programs.
+                   'resume' = Skip the chip jobs that the manifest in
+                   outputDir records as done with the same inputs and
+                   whose outputs are intact.  The input digests are
+                   only computed (reading every trimmed catalog) and
+                   recorded when this is set, so only runs with
+                   'resume' set can be resumed.
         'condor':  'universe' = Condor universe ('vanilla', 'standard', etc)
-        'cluster': 'script_writer' = callback to generate raytrace batch scripts
+        'cluster': 'queue_dir' = JobQueue directory, on a filesystem
+                   shared with the worker hosts (as is the work
+                   directory), to which the trim and chip jobs are
+                   written.  They are run by workers started with
+                   runWorkers (faux_sim.py --worker queue_dir).
+                   Defaults to the 'queue' subdirectory of workDir.
+                   'numproc' = Number of workers to run on this host.
+                   'close_queue' = Tell the workers to exit when the
+                   visit is done.
+                   The other grid 'no' options also apply.
+                   Alternatively, instead of 'queue_dir':
+                   'script_writer' = callback to generate raytrace batch scripts
                    'submitter' = optional callback to submit the job
         """
         self.phosimDir = phosimDir
@@ -225,7 +904,8 @@ class PhosimFocalplane(object):
         self.flatdir = False
         self.extraCommands = None
         self.instanceCatalog = None
-        self.userCatalog = None
+        self.includeCatalogs = []
+        self.nInlineObjects = 0
         self.chipID = None
         self.runFlag = None
         self.devtype = None
@@ -233,6 +913,17 @@ class PhosimFocalplane(object):
         self.grid = opt.grid
         self.grid_opts = grid_opts
         self.execEnvironmentInitialized = False
+        self._trimFields = None
+        self.cache = None
+        if getattr(opt, 'cache_dir', None):
+            self.cache = filecache.FileCache(opt.cache_dir,
+                                             getattr(opt, 'cache_bytes', None))
+        self.pool = None
+        self.nObjects = 0
+        # Grid 'cluster' runs the jobs through a JobQueue unless
+        # batch script callbacks are given.
+        self.queued = (self.grid == 'cluster' and
+                       not self.grid_opts.get('script_writer', None))
         if self.grid == 'condor':
             self.flatdir = (self.grid_opts['universe'] == 'vanilla')
 
@@ -245,15 +936,46 @@ class PhosimFocalplane(object):
         self.generateInstrumentConfig()
         self.trimObjects(sensor)
 
+    @traced('loadInstanceCatalog')
     def loadInstanceCatalog(self, instanceCatalog, extraCommands):
-        """Parse the instance catalog"""
+        """
+        Parse the instance catalog in a single pass: the header lines
+        are parsed, the object lines are copied to
+        objectcatalog_<obsid>.pars in the work directory, and the
+        includeobj catalogs are recorded for writeCatalogList.
+        """
         self.instanceCatalog = instanceCatalog
         self.extraCommands = extraCommands
-        defaultCatalog = open(os.path.join(self.phosimDir,
-                                           'default_instcat')).readlines()
-        self.userCatalog = open(instanceCatalog).readlines()
-        self.params = parse_params(defaultCatalog + self.userCatalog)
-        self.observationID = str(self.params['Opsim_obshistid'])
+        self.params = parse_params(open(os.path.join(self.phosimDir,
+                                                     'default_instcat')))
+        self.includeCatalogs = []
+        self.nInlineObjects = 0
+        # The obsid may follow the objects, so the object catalog is
+        # renamed once the whole catalog has been read.
+        fd, tmpfile = tempfile.mkstemp(prefix='objectcatalog_',
+                                       suffix='.tmp', dir=self.workDir)
+        objectCatalog = os.fdopen(fd, 'w')
+        try:
+            for line in open(instanceCatalog):
+                tokens = line.split(None, 1)
+                if not tokens:
+                    continue
+                if tokens[0] == 'object':
+                    objectCatalog.write(line)
+                    self.nInlineObjects += 1
+                elif tokens[0] == 'includeobj':
+                    self.includeCatalogs.append(tokens[1].split()[0])
+                else:
+                    self.params.update(parse_params([line]))
+            objectCatalog.close()
+            self.observationID = str(self.params['Opsim_obshistid'])
+            if self.nInlineObjects > 0:
+                os.rename(tmpfile, os.path.join(self.workDir,
+                                                'objectcatalog_%s.pars'
+                                                % self.observationID))
+        finally:
+            objectCatalog.close()
+            removeFile(tmpfile)
         self.monthnum = self.params['Slalib_date'].split('/')[1]
         self.nsnap = self.params['SIM_NSNAP']
 
@@ -270,6 +992,7 @@ class PhosimFocalplane(object):
                 except KeyError:
                     pass
 
+    @traced('writeInputParams')
     def writeInputParamsAndCatalogs(self):
         """encapsulate the two instance catalog processing functions."""
         self.writeInputParams()
@@ -306,50 +1029,110 @@ class PhosimFocalplane(object):
         useful for entire focal planes (millions).  Hence we support
         both of these options.
         """
-        l=0
-        objectCatalog=open('objectcatalog_'+self.observationID+'.pars','w')
-        for line in self.userCatalog:
-            if "object" in line:
-                objectCatalog.write(line)
-                l+=1
-        objectCatalog.close()
+        l=self.nInlineObjects
         ncat=0
         catalogList=open('catlist_'+self.observationID+'.pars','w')
         if l>0:
+            # Written by loadInstanceCatalog.
             catalogList.write("catalog %d objectcatalog_%s.pars\n" 
                               % (ncat, self.observationID))
             ncat=1
-        else:
-            removeFile('objectcatalog_'+self.observationID+'.pars')
         catDir = os.path.dirname(self.instanceCatalog)
-        for line in self.userCatalog:
-            if "includeobj" in line:
-                path = os.path.join(catDir, line.split()[1])
-                if not os.path.isabs(catDir):
-                    path = os.path.join("..", path)
-                catalogList.write("catalog %d %s\n" % (ncat, path))
-                ncat+=1
+        for include in self.includeCatalogs:
+            path = os.path.join(catDir, include)
+            if not os.path.isabs(catDir):
+                path = os.path.join("..", path)
+            catalogList.write("catalog %d %s\n" % (ncat, path))
+            ncat+=1
+            # The count only sizes the trim groups, so the includeobj
+            # catalogs are estimated rather than read.
+            l+=estimateObjects(path)
         catalogList.close()
-    def generateAtmosphere(self):
-        """Run the atmosphere program"""
+        self.nObjects=l
+    @traced('atmosphere')
+    def generateAtmosphere(self, regenerate=False):
+        """
+        Run the atmosphere program, or link its screens from the cache.
+        If regenerate is True, the screens are always recomputed.
+        """
         inputParams='obsExtra_'+self.observationID+'.pars'
         pfile=open(inputParams,'w')
         pfile.write(open(self.inputParams).read())
         if self.extraCommands!='none':
             pfile.write(open(self.extraCommands).read())
         pfile.close()
-        runProgram("atmosphere < "+inputParams, self.binDir)
+        self.runCached('atmosphere', inputParams,
+                       ['atmosphere_'+self.observationID+'.pars',
+                        'airglowscreen_'+self.observationID+'.fits',
+                        'atmospherescreen_'+self.observationID+'_*',
+                        'cloudscreen_'+self.observationID+'_*'],
+                       lookup=not regenerate)
         removeFile(inputParams)
+    def runCached(self, program, inputParams, outputs, lookup=True,
+                  ignore=(), fields=()):
+        """
+        Run program < inputParams in the work directory.  If there is
+        a cache, the program's outputs (the files it creates or
+        modifies) are stored under a key made from its parameters
+        (less the _path_keys and the ignore keys), its binary and any
+        extra fields, and linked from there instead when the same
+        inputs come up again.  outputs are glob patterns for the
+        program's outputs, which are removed before it is run, so
+        that links into the cache are never written to.
+        """
+        if self.cache is None:
+            runProgram(program+" < "+inputParams, self.binDir)
+            return
+        binary=os.path.join(self.binDir, program)
+        fields=[program, filecache.fileStamp(binary)] + list(fields)
+        for line in open(inputParams):
+            tokens=line.split()
+            if (tokens and tokens[0] not in _path_keys
+                and tokens[0] not in ignore):
+                fields.append(' '.join(tokens))
+        key=self.cache.key(fields)
+        if lookup and self.cache.get(key) is not None:
+            # Hard links or copies, not symbolic links, so that the
+            # files outlive the eviction of the entry by other runs.
+            names=self.cache.link(key, self.workDir, symlink=False)
+            sys.stdout.write('Linked %d %s outputs from %s\n'
+                             % (len(names), program, self.cache.path(key)))
+            return
+        for pattern in outputs:
+            for f in glob.glob(pattern):
+                removeFile(f)
+        before=filecache.snapshot(self.workDir)
+        runProgram(program+" < "+inputParams, self.binDir)
+        names=filecache.changedFiles(before, filecache.snapshot(self.workDir))
+        self.cache.put(key, [os.path.join(self.workDir, f) for f in names
+                             if f!=inputParams])
+    @traced('instrument')
     def generateInstrumentConfig(self):
-        """Run the instrument program"""
-        runProgram("instrument < "+self.inputParams, self.binDir)
-    def trimObjects(self, sensors):
+        """
+        Run the instrument program, or link its outputs from the cache.
+        """
+        # The key keeps obsseed, which seeds the optics perturbations,
+        # and stamps the instrument data files.
+        stamps=[filecache.fileStamp(os.path.join(self.instrDir, f))
+                for f in sorted(os.listdir(self.instrDir))]
+        self.runCached('instrument', self.inputParams,
+                       ['optics_'+self.observationID+'.pars',
+                        'tracking_'+self.observationID+'.pars',
+                        'chip_'+self.observationID+'_*.pars',
+                        'readout_'+self.observationID+'_*.pars'],
+                       ignore=_atmosphere_keys, fields=stamps)
+    @traced('trimObjects')
+    def trimObjects(self, sensors, callback=None):
         """
         Run the trim program.
         Note this is overly complicated because we want to allow the
         trimming on grid computing to be done in groups to reduce the
         I/O of sending the entire instance catalog for every chip.
         This complex looping isn't necessary for desktops.
+        If callback is given, it is called with the list of chip IDs
+        in each group as soon as that group has been trimmed, e.g.,
+        scheduleChips to start the raytracing of those chips while
+        the other groups are being trimmed.
         """
         self.initExecutionEnvironment()
 
@@ -392,158 +1175,404 @@ class PhosimFocalplane(object):
                         runFlag[i]=1
                         break
 
-        lastchip=chipID[-1]
-        chipcounter1=0
-        chipcounter2=0
-        tc=0
-        i=0
-        for cid in chipID:
-            if chipcounter1==0:
-                jobName='trim_'+self.observationID+'_'+str(tc)
-                inputParams=jobName+'.pars'
-                pfile=open(inputParams,'w')
-
-            pfile.write('chipid %d %s\n' % (chipcounter1, cid))
-            chipcounter1+=1
-            if runFlag[i]==1:
-                chipcounter2+=1
-            if chipcounter1==9 or cid==lastchip:
-                # Do groups of 9 to reduce grid computing I/O
-                pfile.write(open('obs_'+self.observationID+'.pars').read())
-                if self.flatdir:
-                    for line in open('catlist_'+self.observationID+'.pars'):
-                        lstr=line.split()
-                        pfile.write('%s %s %s\n' % (lstr[0],lstr[1],lstr[2].split('/')[-1]))
-                else:
-                    pfile.write(open('catlist_'+self.observationID+'.pars').read())
-                pfile.close()
-                if chipcounter2>0:
-                    if self.grid in ['no', 'cluster']:
-                        runProgram("trim < "+inputParams, self.binDir)
-                    elif self.grid == 'condor':
-                        if devtype[i] == 'CCD':
-                            nexp = self.params['SIM_NSNAP']
-                        else:
-                            nexp = int(self.params['SIM_VISTIME']/devvalue[i])
-                        condor.writeTrimDag(self,jobName,tc,nexp)
-                    else:
-                        sys.stderr.write('Unknown grid type: %s' % self.grid)
-                        sys.exit(-1)
-                if (self.grid in ['no', 'cluster'] or 
-                    (self.grid == 'condor' and chipcounter2==0)):
-                    removeFile(inputParams)
-                chipcounter1=0
-                chipcounter2=0
-                tc+=1
-            i=i+1
         self.chipID = chipID
         self.runFlag = runFlag
         self.devtype = devtype
         self.devvalue = devvalue
+
+        # Chips whose trimmed catalogs are in the cache need no
+        # trimming and can be scheduled right away.
+        trimFlag=list(runFlag)
+        indices=range(len(chipID))
+        if self.cache is not None and self.grid in ['no', 'cluster']:
+            cached=[i for i in indices
+                    if runFlag[i]==1 and self.linkTrimmed(chipID[i])]
+            if cached:
+                sys.stdout.write('Linked %d trimmed catalogs from the cache\n'
+                                 % len(cached))
+                for i in cached:
+                    trimFlag[i]=0
+                if callback is not None:
+                    callback([chipID[i] for i in cached])
+                indices=[i for i in indices if i not in cached]
+
+        # Each trim job reads the entire catalog, so group the chips
+        # to reduce the I/O.  Condor uses groups of 9 consecutive
+        # chips; otherwise the groups hold trimGroupSize() chips to
+        # trim and the chips that are not trimmed go along for cleanup.
+        groups=[]
+        group=[]
+        if self.grid == 'condor':
+            groupSize=9
+        else:
+            groupSize=self.trimGroupSize(sum(trimFlag))
+        for i in indices:
+            group.append(i)
+            if self.grid == 'condor':
+                counter=len(group)
+            else:
+                counter=sum(trimFlag[j] for j in group)
+            if counter==groupSize or i==indices[-1]:
+                groups.append(group)
+                group=[]
+
+        pool=None
+        trimJobs=[]
+        if self.grid == 'no' or self.queued:
+            # Trim under the same core budget as raytrace, sharing its
+            # pool in pipelined mode.
+            pool=self.pool
+            if pool is None:
+                pool=self.jobPool()
+        for tc, group in enumerate(groups):
+            chips=[chipID[i] for i in group]
+            jobName='trim_'+self.observationID+'_'+str(tc)
+            inputParams=jobName+'.pars'
+            pfile=open(inputParams,'w')
+            chipcounter1=0
+            chipcounter2=0
+            for i in group:
+                if self.grid == 'condor' or trimFlag[i]==1:
+                    pfile.write('chipid %d %s\n' % (chipcounter1, chipID[i]))
+                    chipcounter1+=1
+                if trimFlag[i]==1:
+                    chipcounter2+=1
+                    if self.cache is not None:
+                        # Never write through a stale link into the cache.
+                        removeFile('trimcatalog_'+self.observationID+'_'+chipID[i]+'.pars')
+            pfile.write(open('obs_'+self.observationID+'.pars').read())
+            if self.flatdir:
+                for line in open('catlist_'+self.observationID+'.pars'):
+                    lstr=line.split()
+                    pfile.write('%s %s %s\n' % (lstr[0],lstr[1],lstr[2].split('/')[-1]))
+            else:
+                pfile.write(open('catlist_'+self.observationID+'.pars').read())
+            pfile.close()
+            if chipcounter2==0:
+                removeFile(inputParams)
+                if callback is not None:
+                    callback(chips)
+            elif self.grid == 'no' or self.queued:
+                def groupDone(value, chips=chips):
+                    self.storeTrimmed(chips)
+                    if callback is not None:
+                        callback(chips)
+                trimJobs.append(pool.submit(jobName, jobTrim,
+                                            args=(inputParams, self.binDir,
+                                                  [chipID[i] for i in group
+                                                   if trimFlag[i]==1]),
+                                            callback=groupDone))
+            elif self.grid == 'cluster':
+                jobTrim(inputParams, self.binDir,
+                        [chipID[i] for i in group if trimFlag[i]==1])
+                self.storeTrimmed(chips)
+                if callback is not None:
+                    callback(chips)
+            elif self.grid == 'condor':
+                i=group[-1]
+                if devtype[i] == 'CCD':
+                    nexp = self.params['SIM_NSNAP']
+                else:
+                    nexp = int(self.params['SIM_VISTIME']/devvalue[i])
+                condor.writeTrimDag(self,jobName,tc,nexp)
+            else:
+                sys.stderr.write('Unknown grid type: %s' % self.grid)
+                sys.exit(-1)
+        if pool is not None:
+            if pool is self.pool:
+                failures=pool.join(trimJobs)
+                if failures:
+                    raise RuntimeError('%d trim jobs failed: %s'
+                                       % (len(failures), ', '.join(failures)))
+            else:
+                pool.wait()
+    def trimKey(self, cid):
+        """
+        Cache key for the trimmed catalog of a chip: the pointing,
+        rotation, camera configuration, the contents of the object
+        catalogs and focalplanelayout.txt, and the trim binary.
+        """
+        if self._trimFields is None:
+            obs=parse_params(open('obs_'+self.observationID+'.pars'))
+            fields=['trim', filecache.fileStamp(os.path.join(self.binDir, 'trim'))]
+            for key in ('obshistid', 'pointingra', 'pointingdec',
+                        'rotationangle', 'camconfig'):
+                fields.append('%s %r' % (key, obs[key]))
+            fields.append(filecache.fileDigest(os.path.join(self.instrDir, 'focalplanelayout.txt')))
+            for line in open('catlist_'+self.observationID+'.pars'):
+                fields.append(filecache.fileDigest(line.split()[2]))
+            self._trimFields=fields
+        return self.cache.key(self._trimFields + ['chipid '+cid])
+    def linkTrimmed(self, cid):
+        """
+        Link the cached trimmed catalog of a chip into the work
+        directory, returning False if it is not cached.
+        """
+        key=self.trimKey(cid)
+        if self.cache.get(key) is None:
+            return False
+        self.cache.link(key, self.workDir, symlink=False)
+        return True
+    def storeTrimmed(self, chips):
+        """Store the trimmed catalogs of chips in the cache."""
+        if self.cache is None:
+            return
+        keys=[]
+        for cid in chips:
+            f=os.path.join(self.workDir, 'trimcatalog_'+self.observationID+'_'+cid+'.pars')
+            if os.path.exists(f):
+                keys.append(self.trimKey(cid))
+                self.cache.put(keys[-1], [f], evict=False)
+        # Scan the cache once for the whole group.
+        if keys:
+            self.cache.evict(keep=keys)
+    def trimGroupSize(self, nchips):
+        """
+        Number of chips to trim in each group, given the number of
+        chips to run.  This is grid_opts['trim_group'] if set.
+        Otherwise, serial runs and catalogs of fewer than
+        _splitTrimObjects objects use groups of 9, and larger catalogs
+        are split into about one group per worker.
+        """
+        if self.grid_opts.get('trim_group', None):
+            return self.grid_opts['trim_group']
+        numproc=self.grid_opts.get('numproc', 1)
+        if numproc<=1 or self.nObjects < _splitTrimObjects:
+            return 9
+        return max(1, int(math.ceil(float(nchips)/numproc)))
     def scheduleRaytrace(self, instrument='lsst', run_e2adc=True,
                          keep_screens=False):
         """
         set up the raytrace & e2adc jobs and also figures out the
-        numbers of exposures to perform.
+        numbers of exposures to perform.  For the 'no' and 'cluster'
+        grids, grid_opts['ordering'] = 'cost' submits the chip jobs in
+        order of decreasing estimated cost instead of in focal plane
+        layout order.
         """
-        chipcounter1=0
-        tc=0
-        counter=0
-        jobs=[]
-        i=0
-        seg=open(self.instrDir+'/segmentation.txt').readlines()
-        observationID = self.observationID
+        self.startRaytrace(instrument, run_e2adc)
+        self.scheduleChips(self.chipID)
+        self.finishRaytrace(keep_screens)
 
-        for cid in self.chipID:
+    def startRaytrace(self, instrument='lsst', run_e2adc=True):
+        """
+        Prepare for scheduleChips, starting the worker pool for grid
+        'no' or the job queue for grid 'cluster'.
+        """
+        self.instrument = instrument
+        self.run_e2adc = run_e2adc
+        self.pool = None
+        self._obsParams = None
+        self._sharedParams = None
+        self._extraParams = None
+        self._digests = {}
+        if self.grid == 'no' or self.queued:
+            self.pool = self.jobPool()
+            self.manifest = JobManifest(os.path.join(self.outputDir,
+                                                     'manifest_%s.json'
+                                                     % self.observationID))
+
+    @traced('scheduleChips')
+    def scheduleChips(self, chips):
+        """
+        Write the raytrace & e2adc parameter files for the given
+        (trimmed) chips and submit their jobs.
+        """
+        observationID = self.observationID
+        jobs=[]
+        for cid in chips:
+            i=self.chipID.index(cid)
+            # The condor trim groups are groups of 9 chips in layout order.
+            tc=i//9
             if self.runFlag[i]==1:
                 numSources=self.params['SIM_MINSOURCE']
+                flux=0
                 if self.grid in ['no', 'cluster']:
-                    numSources=len(open('trimcatalog_'+observationID+'_'+cid+'.pars').readlines())
-                    numSources=numSources-2
+                    numSources, flux = catalogCost('trimcatalog_'+observationID+'_'+cid+'.pars')
                 if numSources>=self.params['SIM_MINSOURCE']:
                     if self.devtype[i] == 'CCD':
                         nexp = self.params['SIM_NSNAP']
+                        exptime = float(self.params['SIM_VISTIME'])/nexp
                     else:
                         nexp = int(self.params['SIM_VISTIME']/self.devvalue[i])
+                        exptime = self.devvalue[i]
+                    chip=open('chip_'+observationID+'_'+cid+'.pars').read()
+                    readout=open('readout_'+observationID+'_'+cid+'.pars').read()
+                    trimcatalog=os.path.join(self.workDir, 'trimcatalog_'+observationID+'_'+cid+'.pars')
                     ex=0
                     while ex<nexp:
                         eid="E%03d" % (ex)
                         fid=observationID + '_' + cid + '_' + eid
-                        pfile=open('image_'+fid+'.pars','w')
-                        pfile.write("chipid %s\n" % cid)
-                        pfile.write("exposureid %d\n" % ex)
-                        pfile.write("nsnap %d\n" % nexp)
-                        pfile.close()
+                        image="chipid %s\n" % cid
+                        image+="exposureid %d\n" % ex
+                        image+="nsnap %d\n" % nexp
 
                         # PHOTON RAYTRACE
-                        pfile=open('raytrace_'+fid+'.pars','w')
-                        pfile.write(open('obs_'+observationID+'.pars').read())
-                        pfile.write(open('atmosphere_'+observationID+'.pars').read())
-                        pfile.write(open('optics_'+observationID+'.pars').read())
-                        pfile.write(open('chip_'+observationID+'_'+cid+'.pars').read())
-                        pfile.write(open('image_'+fid+'.pars').read())
+                        raytrace=[('text', self.sharedParams()), ('text', chip),
+                                  ('text', image)]
                         if self.extraCommands!='none':
-                            pfile.write(open(self.extraCommands).read())
+                            raytrace.append(('text', self.extraParams()))
                         if self.grid in ['no', 'cluster']:
-                            pfile.write(open('trimcatalog_'+observationID+'_'+cid+'.pars').read())
-                        pfile.close()
+                            raytrace.append(('file', trimcatalog))
 
                         # ELECTRONS TO ADC CONVERTER
-                        if run_e2adc:
-                            pfile=open('e2adc_'+fid+'.pars','w')
-                            pfile.write(open('obs_'+observationID+'.pars').read())
-                            pfile.write(open('readout_'+observationID+'_'+cid+'.pars').read())
-                            pfile.write(open('image_'+fid+'.pars').read())
-                            pfile.close()
-
-                        if self.grid == 'no':
-                            p=multiprocessing.Process(target=jobChip,
-                                                      args=(observationID,cid,eid,self.params['Opsim_filter'], self.outputDir,
-                                                            self.binDir, self.instrDir),
-                                                      kwargs={'instrument': instrument, 'run_e2adc': run_e2adc})
-                            jobs.append(p)
-                            p.start()
-                            counter+=1
-                            if counter==self.grid_opts.get('numproc', 1):
-                                for p in jobs:
-                                    p.join()
-                                counter=0
-                                jobs=[]
-                        elif self.grid == 'cluster':
-                            if self.grid_opts.get('script_writer', None):
-                                self.grid_opts['script_writer'](observationID, cid, eid, self.params['Opsim_filter'],
-                                                                self.outputDir, self.binDir, self.dataDir)
-                            else:
-                                sys.stderr.write('WARNING: No script_writer callback in grid_opts for grid "cluster".\n')
-                            if self.grid_opts.get('submitter', None):
-                                self.grid_opts['submitter'](observationID, cid, eid)
-                            else:
-                                sys.stdout.write('No submitter callback in self.grid_opts for grid "cluster".\n')
-                        elif self.grid == 'condor':
-                            condor.writeRaytraceDag(self,cid,eid,tc,run_e2adc)
+                        e2adc=[('text', self.obsParams()), ('text', readout),
+                               ('text', image)]
+
+                        # Grid 'no' and the job queue stream the
+                        # parameters to the programs' stdin, unless
+                        # files are wanted for debugging.
+                        inputs={}
+                        if (self.grid=='no' or self.queued) and not self.grid_opts.get('write_pars', False):
+                            inputs['raytrace_input']=raytrace
+                            if self.run_e2adc:
+                                inputs['e2adc_input']=e2adc
+                        else:
+                            writeParams('raytrace_'+fid+'.pars', raytrace)
+                            if self.run_e2adc:
+                                writeParams('e2adc_'+fid+'.pars', e2adc)
 
-                        removeFile('image_'+fid+'.pars')
+                        if self.grid in ['no', 'cluster']:
+                            # The input digests read the trimmed
+                            # catalogs, so they are only needed to
+                            # resume.
+                            digest=None
+                            if self.grid_opts.get('resume', False):
+                                digest=self.jobDigest(raytrace, e2adc)
+                            # The number of photons to raytrace scales
+                            # with the source flux and exposure time.
+                            jobs.append(((flux*exptime, numSources), cid, eid,
+                                         inputs, digest))
+                        elif self.grid == 'condor':
+                            writeParams('image_'+fid+'.pars', [('text', image)])
+                            condor.writeRaytraceDag(self,cid,eid,tc,self.run_e2adc)
+                            removeFile('image_'+fid+'.pars')
                         ex+=1
-            chipcounter1+=1
-            if chipcounter1==9:
-                tc+=1
-                chipcounter1=0
 
-            if self.grid in ['no', 'cluster']:
+            # The trimmed catalogs are read by the grid 'no' and
+            # queued jobs, so they are removed by finishRaytrace.
+            if self.grid == 'cluster' and not self.queued:
                 if os.path.exists('trimcatalog_'+observationID+'_'+cid+'.pars'):
                     removeFile('trimcatalog_'+observationID+'_'+cid+'.pars')
             removeFile('readout_'+observationID+'_'+cid+'.pars')
             removeFile('chip_'+observationID+'_'+cid+'.pars')
-            i+=1
+
+        ordering = self.grid_opts.get('ordering', 'layout')
+        if ordering == 'cost':
+            # Longest job first, so that the densest chips do not
+            # start last and leave the other workers idle.
+            jobs.sort(key=lambda job: job[0], reverse=True)
+        elif ordering != 'layout':
+            raise ValueError('Unknown job ordering: %s' % ordering)
+
+        for cost, cid, eid, inputs, digest in jobs:
+            if self.grid == 'no' or self.queued:
+                fid='_'.join((observationID, cid, eid))
+                if (self.grid_opts.get('resume', False) and
+                    self.manifest.isDone(fid, digest)):
+                    sys.stdout.write('Skipping jobChip %s: already done\n' % fid)
+                    continue
+                self.manifest.update(fid, 'submitted', inputs=digest)
+                kwargs=self.chipOptions()
+                kwargs.update(inputs)
+                self.pool.submit('jobChip '+fid,
+                                 jobChip,
+                                 args=(observationID,cid,eid,self.params['Opsim_filter'], self.outputDir,
+                                       self.binDir, self.instrDir),
+                                 kwargs=kwargs,
+                                 callback=lambda outputs, fid=fid:
+                                     self.manifest.update(fid, 'done', outputs=outputs),
+                                 errback=lambda error, fid=fid:
+                                     self.manifest.update(fid, 'failed'))
+            elif self.grid == 'cluster':
+                if self.grid_opts.get('script_writer', None):
+                    self.grid_opts['script_writer'](observationID, cid, eid, self.params['Opsim_filter'],
+                                                    self.outputDir, self.binDir, self.dataDir)
+                else:
+                    sys.stderr.write('WARNING: No script_writer callback in grid_opts for grid "cluster".\n')
+                if self.grid_opts.get('submitter', None):
+                    self.grid_opts['submitter'](observationID, cid, eid)
+                else:
+                    sys.stdout.write('No submitter callback in self.grid_opts for grid "cluster".\n')
+
+    def jobPool(self):
+        """
+        A JobPool for grid 'no' or a QueuePool for grid 'cluster'.
+        """
+        if self.queued:
+            queueDir = self.grid_opts.get('queue_dir',
+                                          os.path.join(self.workDir, 'queue'))
+            return QueuePool(os.path.abspath(queueDir),
+                             self.grid_opts.get('numproc', 0))
+        return JobPool(self.grid_opts.get('numproc', 1))
+
+    def jobDigest(self, raytrace, e2adc):
+        """
+        SHA1 digest of the inputs of a chip job: its raytrace and
+        e2adc parameter fragments and options.
+        """
+        fields=[self.instrument, str(self.run_e2adc)]
+        for kind, value in raytrace + e2adc:
+            if kind == 'file':
+                if value not in self._digests:
+                    self._digests[value]=filecache.fileDigest(value)
+                value=self._digests[value]
+            fields.append(value)
+        return filecache.FileCache.key(fields)
+
+    def obsParams(self):
+        """The contents of obs_<obsid>.pars, read once per visit."""
+        if self._obsParams is None:
+            self._obsParams=open('obs_'+self.observationID+'.pars').read()
+        return self._obsParams
+
+    def sharedParams(self):
+        """
+        The obs, atmosphere and optics parameters shared by the
+        raytrace jobs of every chip, read once per visit.
+        """
+        if self._sharedParams is None:
+            self._sharedParams=(self.obsParams()
+                                + open('atmosphere_'+self.observationID+'.pars').read()
+                                + open('optics_'+self.observationID+'.pars').read())
+        return self._sharedParams
+
+    def extraParams(self):
+        """The contents of the extraCommands file, read once."""
+        if self._extraParams is None:
+            self._extraParams=open(self.extraCommands).read()
+        return self._extraParams
+
+    def chipOptions(self):
+        """Keyword arguments for the jobChip jobs."""
+        kwargs = {'instrument': self.instrument, 'run_e2adc': self.run_e2adc}
+        for key in ('compress_level', 'compress_threads', 'direct_output'):
+            if self.grid_opts.get(key, None) is not None:
+                kwargs[key] = self.grid_opts[key]
+        return kwargs
+
+    @traced('finishRaytrace')
+    def finishRaytrace(self, keep_screens=False):
+        """
+        Remove the parameter files shared by all of the chips and wait
+        for (grids 'no' and 'cluster') or submit (grid 'condor') the
+        chip jobs.
+        """
+        observationID = self.observationID
         removeFile('obs_'+observationID+'.pars')
         if not keep_screens:
             removeFile('atmosphere_'+observationID+'.pars')
         removeFile('optics_'+observationID+'.pars')
         removeFile('catlist_'+observationID+'.pars')
 
-        if self.grid == 'no':
-            for p in jobs:
-                p.join()
+        if self.grid == 'no' or self.queued:
+            try:
+                self.pool.wait()
+            finally:
+                self.manifest.save()
+                if self.queued and self.grid_opts.get('close_queue', False):
+                    self.pool.queue.close()
+                for f in glob.glob('trimcatalog_'+observationID+'_*.pars'):
+                    removeFile(f)
         elif self.grid == 'condor':
             condor.submitDag(self)
         os.chdir(self.phosimDir)
@@ -559,6 +1588,7 @@ class PhosimFocalplane(object):
            self.initClusterEnvironment()
        self.execEnvironmentInitialized = True
 
+    @traced('cleanup')
     def cleanup(self, keep_screens):
         """general method to delete files at end"""
         if self.grid in ['no', 'cluster']:
@@ -572,14 +1602,15 @@ class PhosimFocalplane(object):
                 for f in glob.glob('cloudscreen_'+self.observationID+'_*') :
                     removeFile(f)
             else:
+                # Hard link (or copy) rather than duplicate the screens.
                 f='atmosphere_'+self.observationID+'.pars'
-                shutil.copy(f,self.outputDir+'/'+f)
+                filecache.linkFile(f,self.outputDir+'/'+f,symlink=False)
                 f='airglowscreen_'+self.observationID+'.fits'
-                shutil.copy(f,self.outputDir+'/'+f)
+                filecache.linkFile(f,self.outputDir+'/'+f,symlink=False)
                 for f in glob.glob('atmospherescreen_'+self.observationID+'_*') :
-                    shutil.copy(f,self.outputDir+'/'+f)
+                    filecache.linkFile(f,self.outputDir+'/'+f,symlink=False)
                 for f in glob.glob('cloudscreen_'+self.observationID+'_*') :
-                    shutil.copy(f,self.outputDir+'/'+f)
+                    filecache.linkFile(f,self.outputDir+'/'+f,symlink=False)
             if self.eventfile==1:
                 f='output.fits'
                 shutil.move(f,self.outputDir+'/'+f)
@@ -593,6 +1624,17 @@ class PhosimFocalplane(object):
                 f='opd.fits'
                 shutil.move(f,self.outputDir+'/'+f)
             os.chdir(self.phosimDir)
+    def reportUsage(self, stream=sys.stdout):
+        """
+        Print the resource usage of the programs run for this visit and
+        save it as usage_<obsid>.txt in the output directory.
+        """
+        table = accounting.summary()
+        stream.write(table)
+        output = open(os.path.join(self.outputDir,
+                                   'usage_%s.txt' % self.observationID), 'w')
+        output.write(table)
+        output.close()
     def initCondorEnvironment(self):
         """Set up directories for Condor"""
         sys.path.append(self.phosimDir+'/condor')
@@ -603,17 +1645,26 @@ class PhosimFocalplane(object):
         """Cluster methods"""
         pass
 
-def main():
+def phosimDirs():
+    """
+    The phoSim installation and bin directories, from $PHOSIMDIR or
+    else the location of raytrace in the PATH.
+    """
     try:
         phosimDir = os.environ['PHOSIMDIR']
         binDir = os.path.join(phosimDir, 'bin')
     except KeyError:
         binDir = os.path.split(distutils.spawn.find_executable('raytrace'))[0]
         phosimDir = os.path.split(binDir)[0]
+    return phosimDir, binDir
+
+def main():
+    phosimDir, binDir = phosimDirs()
 
     output_dir = '.'
     
-    parser = optparse.OptionParser(usage='%prog instance_catalog [<arg1> <arg2> ...]')
+    parser = optparse.OptionParser(usage='%prog instance_catalog [<arg1> <arg2> ...]\n'
+                                   '       %prog --worker queue_dir [-p numproc]')
     parser.add_option('-c', '--command', dest="extraCommands", default="none")
     parser.add_option('-p', '--proc', dest="numproc", default=1, type="int")
     parser.add_option('-o', '--output', dest="output_dir", default=output_dir)
@@ -624,7 +1675,14 @@ def main():
                       default=os.path.join(phosimDir, 'data', 'SEDs'))
     parser.add_option('-s', '--sensor', dest="sensor", default="all")
     parser.add_option('-i', '--instrument', dest="instrument", default="lsst")
-    parser.add_option('-g', '--grid', dest="grid", default="no")
+    parser.add_option('-g', '--grid', dest="grid", default="no",
+                      help="'no' (worker processes on this host), "
+                      "'cluster' (job queue on a shared filesystem, with "
+                      "-p workers on this host) or 'condor'")
+    parser.add_option('--schedule', dest="ordering", default="layout",
+                      type="choice", choices=('layout', 'cost'),
+                      help="chip job ordering: 'layout' or 'cost' "
+                      "(most expensive first)")
     parser.add_option('-u', '--universe', dest="universe", default="standard")
     parser.add_option('-e', '--e2adc',
                       action="store_true", default=True)
@@ -635,35 +1693,108 @@ def main():
     parser.add_option('-r', '--regenerate_screens',
                       action="store_true", default=False, 
                       help="Flag to regenerate atmosphere screens")
+    parser.add_option('--trim-group', dest="trim_group", default=None,
+                      type="int", help="number of chips per trim job "
+                      "(default: chosen from the catalog size and -p)")
+    parser.add_option('--gzip-level', dest="compress_level", default=6,
+                      type="int", help="gzip compression level of the images")
+    parser.add_option('--gzip-threads', dest="compress_threads", default=4,
+                      type="int", help="threads per chip job for gzipping "
+                      "the images")
+    parser.add_option('--gzip-in-workdir', dest="direct_output",
+                      action="store_false", default=True,
+                      help="gzip the images in the work directory and then "
+                      "move them to the output directory")
+    parser.add_option('--write-pars', dest="write_pars", action="store_true",
+                      default=False, help="write the raytrace & e2adc "
+                      "parameter files (for debugging)")
+    parser.add_option('--cache-dir', dest="cache_dir",
+                      default=os.environ.get('PHOSIM_CACHE_DIR', None),
+                      help="directory for caching atmosphere screens, "
+                      "instrument configurations and trimmed catalogs "
+                      "between runs (default $PHOSIM_CACHE_DIR)")
+    parser.add_option('--cache-size', dest="cache_size", default=20.,
+                      type="float", help="cache size limit in GB")
+    parser.add_option('--resume', action="store_true", default=False,
+                      help="skip chip jobs already completed according to "
+                      "the manifest in the output directory; only runs "
+                      "with --resume can be resumed")
+    parser.add_option('--trace', dest="trace", default=None,
+                      help="write a Chrome trace-event JSON file of the "
+                      "timings of every stage")
+    parser.add_option('--pipeline', action="store_true", default=False,
+                      help="start the raytrace jobs for each trim group "
+                      "as soon as it has been trimmed")
+
+    parser.add_option('--queue', dest="queue_dir", default=None,
+                      help="job queue directory for grid 'cluster' "
+                      "(default: <output>/work/queue)")
+    parser.add_option('--close-queue', dest="close_queue",
+                      action="store_true", default=False,
+                      help="tell the queue workers to exit when this "
+                      "visit is done")
+    parser.add_option('--worker', dest="worker", default=None,
+                      help="run -p workers for the job queue in this "
+                      "directory instead of simulating a visit")
+    parser.add_option('--idle-timeout', dest="idle_timeout", default=None,
+                      type="float", help="seconds after which idle "
+                      "workers exit")
 
     if not sys.argv[1:]:
         parser.print_help()
         sys.exit()
 
     opt, args = parser.parse_args(sys.argv[1:])
+    if opt.worker is not None:
+        runWorkers(opt.worker, opt.numproc, opt.idle_timeout)
+        return
     instanceCatalog = args[0]
+    if opt.pipeline and opt.grid == 'condor':
+        parser.error('--pipeline is not supported for grid "condor"')
 
     checkPaths(opt, phosimDir)
+    opt.cache_bytes = int(opt.cache_size*1024**3)
 
-    grid_opts = {'numproc': opt.numproc}
+    grid_opts = {'numproc': opt.numproc, 'ordering': opt.ordering,
+                 'trim_group': opt.trim_group,
+                 'compress_level': opt.compress_level,
+                 'compress_threads': opt.compress_threads,
+                 'direct_output': opt.direct_output,
+                 'write_pars': opt.write_pars, 'resume': opt.resume}
     if opt.grid == 'condor':
         grid_opts = {'universe': opt.universe, 'checkpoint': opt.checkpoint}
     elif opt.grid == 'cluster':
-        grid_opts = {'script_writer': jobChip}
+        grid_opts['close_queue'] = opt.close_queue
+        if opt.queue_dir is not None:
+            grid_opts['queue_dir'] = os.path.abspath(opt.queue_dir)
+
+    if opt.trace is not None:
+        opt.trace = os.path.abspath(opt.trace)
+        tracer.enabled = True
 
     # The standard phosim workflow:
-    fp = PhosimFocalplane(phosimDir, opt, grid_opts)
-    fp.loadInstanceCatalog(instanceCatalog, opt.extraCommands)
-    os.chdir(opt.workDir)
-    fp.writeInputParamsAndCatalogs()
-    atm_par_file = os.path.join(fp.workDir,
-                                'atmosphere_%s.pars' % fp.observationID)
-    if (opt.regenerate_screens or not os.path.exists(atm_par_file)):
-        fp.generateAtmosphere()
-    fp.generateInstrumentConfig()
-    fp.trimObjects(opt.sensor)
-    fp.scheduleRaytrace(opt.instrument, opt.e2adc, opt.keepscreens)
-    fp.cleanup(opt.keepscreens)
+    try:
+        fp = PhosimFocalplane(phosimDir, opt, grid_opts)
+        fp.loadInstanceCatalog(instanceCatalog, opt.extraCommands)
+        os.chdir(opt.workDir)
+        fp.writeInputParamsAndCatalogs()
+        atm_par_file = os.path.join(fp.workDir,
+                                    'atmosphere_%s.pars' % fp.observationID)
+        if (opt.regenerate_screens or not os.path.exists(atm_par_file)):
+            fp.generateAtmosphere(regenerate=opt.regenerate_screens)
+        fp.generateInstrumentConfig()
+        if opt.pipeline:
+            fp.startRaytrace(opt.instrument, opt.e2adc)
+            fp.trimObjects(opt.sensor, callback=fp.scheduleChips)
+            fp.finishRaytrace(opt.keepscreens)
+        else:
+            fp.trimObjects(opt.sensor)
+            fp.scheduleRaytrace(opt.instrument, opt.e2adc, opt.keepscreens)
+        fp.cleanup(opt.keepscreens)
+        fp.reportUsage()
+    finally:
+        if opt.trace is not None:
+            tracer.write(opt.trace)
 
 if __name__ == "__main__":
     main()
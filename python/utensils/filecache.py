@@ -0,0 +1,207 @@
+"""
+Aim:
+====
+Share the expensive intermediate products of phoSim runs, such as the
+atmosphere screens, between work directories.
+
+Summary:
+========
+FileCache is a directory of entries, each holding the files produced
+by one program run and named by a SHA1 digest of that run's inputs.
+Entries are written to a temporary directory and renamed into place,
+so concurrent runs never see a partial entry.  Files are linked into
+the directories that need them (hard link if possible, else symbolic
+link, else copy).  Reading an entry updates its modification time,
+and the least recently used entries are evicted once the cache grows
+beyond max_bytes.  faux_sim.py uses it when given --cache-dir or
+$PHOSIM_CACHE_DIR:
+
+    cache = FileCache('/scratch/phosim_cache', max_bytes=20*1024**3)
+    key = cache.key(['atmosphere', obs_params, extra_commands])
+    if cache.get(key) is None:
+        ...run the program...
+        cache.put(key, output_files)
+    cache.link(key, workDir)
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+
+def fileStamp(filename):
+    """Size and modification time of a file, e.g., a program binary."""
+    try:
+        stat = os.stat(filename)
+        return '%s:%d:%r' % (filename, stat.st_size, stat.st_mtime)
+    except OSError:
+        return filename
+
+def fileDigest(filename):
+    """SHA1 digest of the contents of a file."""
+    sha1 = hashlib.sha1()
+    input = open(filename, 'rb')
+    for chunk in iter(lambda: input.read(1 << 20), b''):
+        sha1.update(chunk)
+    input.close()
+    return sha1.hexdigest()
+
+def snapshot(directory):
+    """Map the names of the files in a directory onto (size, mtime)."""
+    files = dict()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            files[name] = (stat.st_size, stat.st_mtime)
+    return files
+
+def changedFiles(before, after):
+    """Names of the files that are new or modified between snapshots."""
+    return sorted(name for name, stamp in after.items()
+                  if before.get(name) != stamp)
+
+def linkFile(src, dest, symlink=True):
+    """
+    Make dest refer to src: a hard link if possible, else a symbolic
+    link (if symlink is True), else a copy.  An existing dest is
+    replaced.  Without symlink, a symbolic link src is resolved
+    first, so that dest never refers to it.
+    """
+    if not symlink:
+        src = os.path.realpath(src)
+    if os.path.lexists(dest):
+        if os.path.exists(dest) and os.path.samefile(src, dest):
+            return
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+        return
+    except (OSError, AttributeError):
+        pass
+    if symlink:
+        try:
+            os.symlink(os.path.abspath(src), dest)
+            return
+        except (OSError, AttributeError):
+            pass
+    shutil.copy2(src, dest)
+
+class FileCache(object):
+    """
+    Content-addressed cache of program outputs with LRU eviction by
+    total size.
+    """
+    def __init__(self, root, max_bytes=None):
+        """
+        root:      Cache directory, created if needed.
+        max_bytes: Size above which the least recently used entries
+                   are removed, or None for no limit.
+        """
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                # Created by a concurrent run.
+                if not os.path.isdir(self.root):
+                    raise
+
+    @staticmethod
+    def key(fields):
+        """SHA1 digest of a sequence of strings."""
+        sha1 = hashlib.sha1()
+        for field in fields:
+            sha1.update(('%d:' % len(field)).encode('utf-8'))
+            sha1.update(field.encode('utf-8'))
+        return sha1.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        """
+        Directory of the entry for key, or None if it is not cached.
+        Marks the entry as recently used.
+        """
+        path = self.path(key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            # Evicted meanwhile.
+            return None
+        return path
+
+    def files(self, key):
+        """Names of the files in the entry for key."""
+        return sorted(os.listdir(self.path(key)))
+
+    def put(self, key, filenames, evict=True):
+        """
+        Store copies (or hard links) of filenames as the entry for
+        key, unless it already exists, then evict old entries.
+        Evicting scans the whole cache, so a caller storing many
+        entries can pass evict=False and call evict() once after.
+        """
+        if self.get(key) is not None:
+            return self.path(key)
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=self.root)
+        try:
+            for filename in filenames:
+                linkFile(filename, os.path.join(tmpdir,
+                                                os.path.basename(filename)),
+                         symlink=False)
+            os.rename(tmpdir, self.path(key))
+        except OSError:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            if self.get(key) is None:
+                raise
+        if evict:
+            self.evict(keep=[key])
+        return self.path(key)
+
+    def link(self, key, directory, symlink=True):
+        """
+        Link the files of the entry for key into directory and return
+        their names.
+        """
+        names = self.files(key)
+        for name in names:
+            linkFile(os.path.join(self.path(key), name),
+                     os.path.join(directory, name), symlink=symlink)
+        return names
+
+    def size(self, key):
+        path = self.path(key)
+        return sum(os.path.getsize(os.path.join(path, name))
+                   for name in os.listdir(path))
+
+    def evict(self, keep=()):
+        """
+        Remove the least recently used entries, other than the keys
+        in keep, until the cache is no larger than max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        total = 0
+        for key in os.listdir(self.root):
+            if key.startswith('.tmp-'):
+                continue
+            try:
+                size = self.size(key)
+                mtime = os.path.getmtime(self.path(key))
+            except OSError:
+                continue
+            entries.append((mtime, key, size))
+            total += size
+        entries.sort()
+        for mtime, key, size in entries:
+            if total <= self.max_bytes:
+                break
+            if key in keep:
+                continue
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            total -= size
@@ -8,82 +8,274 @@ Summary:
 CatSim produces (and PhoSim requires) object magnitudes defined at 
 500nm AB magnitude. This script converts this quantity into the more
 usual observed magnitde in LSST filter bands. It uses the filter 
-throughput curves, taken by default from the LSST trac web repository. 
+throughput curves, taken by default from the LSST trac web repository
+and kept in a local store (see utensils.throughputs) after the first
+download. 
 
+getPhosimMags does the same for every object in an instance catalog,
+streaming the object lines in chunks over a pool of processes and
+returning NumPy columns of magnitudes.
 
 """
 
 
 
 
+import itertools
+import multiprocessing
 import numpy as np
-import gzip, bz2
+from utensils import extinction
 from utensils import phot
+from utensils import sedlib
+from utensils import throughputs
+from utensils.persistence import openFile
+
+# Number of source parameters following the source type in an instance
+# catalog object line.
+_source_params = {'point': 0, 'gauss': 1, 'movingpoint': 2, 'sersic2d': 4,
+                  'sersic2': 4, 'sersic': 6, 'pinhole': 4}
 
 def getPhosimMag(filter_str, mag_norm, SED_str, redshift=0.0,
                  dust_rest_name='ccm', internal_Av=0.0, internal_Rv=3.1,
-                 dust_lab_name='ccm', galactic_Av=0.0, galactic_Rv=3.1):
+                 dust_lab_name='ccm', galactic_Av=0.0, galactic_Rv=3.1,
+                 sed_library=None, cache=None):
     """ Compute fiducial magnitude given phoSim instance catalog parameters.
+
+    filter_str is one of 'ugrizy' for the LSST baseline throughputs
+    (read from the local store in utensils.throughputs), or the name
+    or url of a user supplied throughput file.  If an
+    sedlib.SEDLibrary is given, the SED is taken from it instead of
+    being read from SED_str.  If a magcache.MagnitudeCache is given,
+    the magnitude is looked up there first and stored after it has
+    been computed.
     """
-    import urllib2
+    bandpass = throughputs.getBandpass(filter_str)
 
-    # read in filter throughput
-    try:
-        if filter_str == 'y':
-            urldir = 'https://dev.lsstcorp.org/trac/export/29728/sims/throughputs/tags/1.2/baseline/'
-            urlfile = urldir + 'total_y4.dat'
-            print 'reading throughput curve from {}.'.format(urlfile)
-            file_ = urllib2.urlopen(urlfile)
-        elif filter_str in 'ugriz':
-            urldir = 'https://dev.lsstcorp.org/trac/export/29728/sims/throughputs/tags/1.2/baseline/'
-            urlfile = urldir + 'total_{}.dat'.format(filter_str)
-            print 'reading throughput curve from {}.'.format(urlfile)
-            file_ = urllib2.urlopen(urlfile)
-        elif filter_str.startswith('http'):
-            print 'opening user url'
-            file_ = urllib2.urlopen(filter_str)
+    if cache is not None:
+        if sed_library is not None:
+            sed_stamp = cache.sedStamp(sed_library.path(SED_str))
         else:
-            print 'opening user file'
-            if filter_str.endswith('.gz'):
-                print 'decompressing gz file'
-                file_ = gzip.open(filter_str)
-            elif filter_str.endswith('.bz2'):
-                print 'decompressing bz2 file'
-                file_ = bzip2.open(filter_str)
-            else:
-                file_ = open(filter_str)
-    except Exception:
-        print 'Could not open {}'.format(filter_str)
-    filter_wave, filter_throughput = np.genfromtxt(file_).T
-    bandpass = phot.Bandpass(filter_wave, filter_throughput)
-
-    # create a mock "normalization" filter with delta-response at 500nm, which is effectively
-    # how phoSim normalizes its input catalog
-    norm_bandpass = phot.Bandpass([499.9, 500, 500.1], [0.0, 1.0, 0.0])
+            sed_stamp = cache.sedStamp(SED_str)
+        key = cache.key(bandpass.fingerprint(), sed_stamp, mag_norm, redshift,
+                        internal_Av, internal_Rv, galactic_Av, galactic_Rv)
+        found = cache.get([key])
+        if key in found:
+            return found[key]
+        mag = getPhosimMag(filter_str, mag_norm, SED_str, redshift,
+                           dust_rest_name, internal_Av, internal_Rv,
+                           dust_lab_name, galactic_Av, galactic_Rv,
+                           sed_library=sed_library)
+        cache.put([(key, mag)])
+        return mag
 
     # read in SED
-    try:
-        if SED_str.startswith('http'):
-            file_ = urllib2.urlopen(SED_str)
-        else:
-            print 'opening user file'
-            if SED_str.endswith('.gz'):
-                print 'decompressing gz file'
-                file_ = gzip.open(SED_str)
-            elif SED_str.endswith('.bz2'):
-                print 'decompressing bz2 file'
-                file_ = bzip2.open(SED_str)
-            else:
-                file_ = open(SED_str)
-    except Exception:
-        print 'Could not open {}'.format(SED_str)
-    SED_wave, SED_flambda = np.genfromtxt(file_).T
-
-    # manipulate SED for normalization, internal and galactic extinction, and redshift
-    SED = phot.SED(SED_wave, SED_flambda)
-    SED.scale(mag_norm, norm_bandpass)
-    SED.apply_extinction(internal_Av, internal_Rv)
-    SED.apply_redshift(redshift)
-    SED.apply_extinction(galactic_Av, galactic_Rv)
+    if sed_library is not None:
+        SED = sed_library.sed(SED_str)
+    else:
+        SED_wave, SED_flambda = np.genfromtxt(openFile(SED_str)).T
+        SED = phot.SED(SED_wave, SED_flambda)
+
+    # manipulate SED for normalization, internal and galactic extinction,
+    # and redshift, lazily and without modifying the SED's arrays
+    SED = SED.chain().scaled(mag_norm, phot.phosim_norm)
+    SED = SED.extincted(internal_Av, internal_Rv).redshifted(redshift)
+    SED = SED.extincted(galactic_Av, galactic_Rv)
     # return the magnitude
     return SED.magnitude(bandpass)
+
+def _parseDust(tokens, i):
+    name = tokens[i]
+    av, rv = 0.0, 3.1
+    try:
+        av, rv = float(tokens[i+1]), float(tokens[i+2])
+        i += 3
+    except (IndexError, ValueError):
+        i += 1
+    if name.lower() == 'none':
+        av = 0.0
+    return av, rv, i
+
+def parseObject(line):
+    """
+    Return (id, mag_norm, SED, redshift, internal_Av, internal_Rv,
+    galactic_Av, galactic_Rv) for an instance catalog object line.  A
+    dust model of 'none' gives zero extinction.
+    """
+    tokens = line.split()
+    source_type = tokens[12].lower()
+    try:
+        i = 13 + _source_params[source_type]
+    except KeyError:
+        raise ValueError('Unknown source type %s in line\n%s'
+                         % (tokens[12], line))
+    internal_Av, internal_Rv, i = _parseDust(tokens, i)
+    galactic_Av, galactic_Rv, i = _parseDust(tokens, i)
+    return (tokens[1], float(tokens[4]), tokens[5], float(tokens[6]),
+            internal_Av, internal_Rv, galactic_Av, galactic_Rv)
+
+def _objectChunks(catalog, chunk_size):
+    lines = (line for line in open(catalog)
+             if line.startswith('object'))
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+# Per-process state for getPhosimMags.
+_mags_state = dict()
+
+def _initMags(filters, sed_dir, libdir, dwave):
+    _mags_state['bandpass_set'] = throughputs.getBandpassSet(filters, dwave)
+    _mags_state['library'] = sedlib.SEDLibrary(libdir, sed_dir=sed_dir,
+                                               cache_size=4096)
+
+def _chunkMags(lines):
+    bandpass_set = _mags_state['bandpass_set']
+    library = _mags_state['library']
+    dtype = [('id', 'S32')] + [(name, float) for name in bandpass_set.names]
+    result = np.zeros(len(lines), dtype=dtype)
+    chains = []
+    galactic_Av = np.zeros(len(lines))
+    galactic_Rv = np.zeros(len(lines))
+    for i, line in enumerate(lines):
+        (result['id'][i], mag_norm, SED_str, redshift, internal_Av,
+         internal_Rv, galactic_Av[i], galactic_Rv[i]) = parseObject(line)
+        SED = library.sed(SED_str).chain().scaled(mag_norm, phot.phosim_norm)
+        chains.append(SED.extincted(internal_Av, internal_Rv).redshifted(redshift))
+    # Galactic extinction is applied on the shared grid for the whole
+    # chunk at once, with the f99 model used by SED.extincted.
+    photons = bandpass_set.resample(chains)
+    wave = bandpass_set.wave
+    valid = (wave > 91) & (wave < 5988)
+    photons[:, ~valid] = 0
+    photons[:, valid] /= extinction.reddening_batch(wave[valid]*10,
+                                                    galactic_Av, galactic_Rv,
+                                                    model='f99')
+    mags = bandpass_set.magnitudes(photons)
+    for i, name in enumerate(bandpass_set.names):
+        result[name] = mags[:, i]
+    return result
+
+def _cachedChunkMags(chunks, cache, mapper, ngroup, filters, sed_dir, libdir,
+                     dwave):
+    """
+    Look up the objects of each chunk in the cache, hand only the
+    missing ones to mapper, and store their magnitudes.  Chunks are
+    processed ngroup at a time.
+    """
+    bandpass_set = throughputs.getBandpassSet(filters, dwave)
+    fingerprints = ['%s:%r' % (bandpass.fingerprint(), dwave)
+                    for bandpass in bandpass_set.bandpasses]
+    library = sedlib.SEDLibrary(libdir, sed_dir=sed_dir, cache_size=1)
+    results = []
+    while True:
+        group = list(itertools.islice(chunks, ngroup))
+        if not group:
+            return results
+        pending = []
+        for lines in group:
+            ids, keys = [], []
+            for line in lines:
+                row = parseObject(line)
+                ids.append(row[0])
+                sed_stamp = cache.sedStamp(library.path(row[2]))
+                keys.append([cache.key(fingerprint, sed_stamp, row[1],
+                                       *row[3:])
+                             for fingerprint in fingerprints])
+            found = cache.get(key for row_keys in keys for key in row_keys)
+            missing = [i for i, row_keys in enumerate(keys)
+                       if not all(key in found for key in row_keys)]
+            pending.append((ids, keys, found, missing))
+        todo = [[lines[i] for i in missing]
+                for lines, (ids, keys, found, missing) in zip(group, pending)]
+        for (ids, keys, found, missing), computed in zip(pending,
+                                                         mapper(_chunkMags,
+                                                                todo)):
+            result = np.zeros(len(ids), dtype=computed.dtype)
+            result['id'] = ids
+            for j, name in enumerate(bandpass_set.names):
+                result[name] = [found.get(row_keys[j], np.nan)
+                                for row_keys in keys]
+            if missing:
+                result[missing] = computed
+                cache.put((keys[i][j], result[name][i])
+                          for i in missing
+                          for j, name in enumerate(bandpass_set.names))
+            results.append(result)
+
+def _filterList(filters):
+    """A string of band letters is one filter per letter."""
+    if isinstance(filters, basestring) and not set(filters) <= set('ugrizy'):
+        return [filters]
+    return list(filters)
+
+def magnitudePool(processes, filters='ugrizy', sed_dir=None, libdir=None,
+                  dwave=1.0):
+    """
+    A multiprocessing.Pool of getPhosimMags workers, to be shared by
+    the getPhosimMags calls with the same filters, sed_dir, libdir and
+    dwave.  The caller closes it.
+    """
+    return multiprocessing.Pool(processes, _initMags,
+                                (_filterList(filters), sed_dir, libdir,
+                                 dwave))
+
+def getPhosimMags(catalog, filters='ugrizy', sed_dir=None, libdir=None,
+                  processes=1, chunk_size=10000, dwave=1.0, cache=None,
+                  pool=None):
+    """
+    Compute the magnitudes of all of the objects in a phoSim instance
+    catalog.
+
+    catalog:    Instance catalog file.  Only the "object" lines are used.
+    filters:    Sequence of filters, as for getPhosimMag.  A string of
+                band letters, e.g. 'ugrizy', is one filter per letter;
+                any other string, e.g. a throughput file, is a single
+                filter.
+    sed_dir:    Directory the catalog SED paths are relative to.
+    libdir:     Optional packed SED library (see sedlib).
+    processes:  Number of worker processes.
+    chunk_size: Number of object lines handed to a worker at a time.
+    dwave:      Wavelength spacing (nm) of the integration grid.
+    cache:      Optional magcache.MagnitudeCache; only objects missing
+                from it are computed.
+    pool:       Optional pool from magnitudePool, used instead of
+                starting processes new workers.
+
+    Returns a structured array, in catalog order, with an 'id' column
+    and one magnitude column per filter.  The magnitudes are integrated
+    on a shared dwave grid (see phot.BandpassSet) rather than on the
+    throughput curve's own sampling.
+    """
+    filters = _filterList(filters)
+    initargs = (filters, sed_dir, libdir, dwave)
+    chunks = _objectChunks(catalog, chunk_size)
+    # The pool started here, as opposed to one passed in.
+    ownPool = None
+    if pool is None and processes != 1:
+        pool = ownPool = multiprocessing.Pool(processes, _initMags, initargs)
+    if pool is not None:
+        mapper = pool.imap
+    else:
+        _initMags(*initargs)
+        mapper = lambda func, chunks: (func(chunk) for chunk in chunks)
+    try:
+        if cache is None:
+            results = list(mapper(_chunkMags, chunks))
+        else:
+            results = _cachedChunkMags(chunks, cache, mapper,
+                                       max(processes, 1), *initargs)
+    except BaseException:
+        # Do not leave the workers running on the remaining chunks.
+        if ownPool is not None:
+            ownPool.terminate()
+        raise
+    finally:
+        if ownPool is not None:
+            ownPool.close()
+            ownPool.join()
+    if not results:
+        _initMags(*initargs)
+        return _chunkMags([])
+    return np.concatenate(results)
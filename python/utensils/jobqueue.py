@@ -0,0 +1,251 @@
+"""
+Aim:
+====
+Run the chip jobs of a visit on several hosts that share a filesystem,
+without a batch system.
+
+Summary:
+========
+A JobQueue is a directory with pending/, claimed/, done/ and failed/
+subdirectories.  The planner writes one JSON descriptor per job into
+pending/, and workers on any host claim jobs by renaming their
+descriptors into claimed/.  The rename is atomic, so each job is
+claimed by exactly one worker.  A worker touches its claimed
+descriptor while the job runs, and writes the descriptor with the
+job's result into done/ or failed/ when it finishes.  Jobs whose
+workers have stopped touching them are returned to pending/ by
+requeueStale.  faux_sim.py uses it for grid 'cluster':
+
+    queue = JobQueue('/shared/phosim_queue')
+    queue.put('000000_chip', {'target': 'jobChip', ...})
+    ...
+    runWorker(queue, handler)            # on each worker host
+    ...
+    state, record = queue.result('000000_chip')
+"""
+import os
+import json
+import socket
+import tempfile
+import threading
+import time
+
+_states = ('pending', 'claimed', 'done', 'failed')
+
+class JobQueue(object):
+    """
+    Directory of job descriptors, claimed by workers with atomic
+    renames.
+    """
+    def __init__(self, root):
+        """
+        root:  Queue directory on a filesystem shared by the planner
+               and the workers, created if needed.
+        """
+        self.root = os.path.abspath(root)
+        for state in _states:
+            path = self.path(state)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # Created by a concurrent process.
+                    if not os.path.isdir(path):
+                        raise
+
+    def path(self, state, name=None):
+        if name is None:
+            return os.path.join(self.root, state)
+        return os.path.join(self.root, state, name + '.json')
+
+    def _write(self, filename, record):
+        """Write a JSON record atomically."""
+        fd, tmpfile = tempfile.mkstemp(prefix='.tmp-', dir=self.root)
+        output = os.fdopen(fd, 'w')
+        json.dump(record, output, indent=1, sort_keys=True)
+        output.close()
+        os.rename(tmpfile, filename)
+
+    def _read(self, filename):
+        try:
+            return json.load(open(filename))
+        except (IOError, ValueError):
+            return None
+
+    def put(self, name, descriptor):
+        """
+        Add a job.  Jobs are claimed in order of name.  Any result of
+        an earlier job of the same name is discarded, and the queue is
+        reopened if it was closed.
+        """
+        for state in ('done', 'failed'):
+            try:
+                os.remove(self.path(state, name))
+            except OSError:
+                pass
+        try:
+            os.remove(os.path.join(self.root, 'closed'))
+        except OSError:
+            pass
+        self._write(self.path('pending', name), descriptor)
+
+    def pending(self):
+        """Names of the pending jobs, in order."""
+        return sorted(os.path.splitext(x)[0]
+                      for x in os.listdir(self.path('pending'))
+                      if x.endswith('.json'))
+
+    def claim(self, worker):
+        """
+        Claim the first pending job that no other worker claims first
+        and return its name and descriptor, or None if there are no
+        pending jobs.
+        """
+        for name in self.pending():
+            filename = self.path('claimed', name)
+            try:
+                os.rename(self.path('pending', name), filename)
+                # The rename keeps the time the job was queued, which
+                # requeueStale must not take for a stale claim.
+                os.utime(filename, None)
+            except OSError:
+                # Claimed by another worker.
+                continue
+            descriptor = self._read(filename)
+            if descriptor is None:
+                self.finish(name, False, {'error': 'Unreadable descriptor'})
+                continue
+            descriptor['worker'] = worker
+            descriptor['claimed'] = time.time()
+            self._write(filename, descriptor)
+            return name, descriptor
+        return None
+
+    def touch(self, name):
+        """Mark a claimed job as still running."""
+        try:
+            os.utime(self.path('claimed', name), None)
+        except OSError:
+            pass
+
+    def finish(self, name, succeeded, result, worker=None):
+        """
+        Move a claimed job to done/ or failed/ along with its result.
+        If worker is given and the job is no longer claimed by it,
+        e.g., because it was requeued, the result is discarded and
+        False is returned.
+        """
+        filename = self.path('claimed', name)
+        record = self._read(filename)
+        if worker is not None and (record is None or
+                                   record.get('worker') != worker):
+            return False
+        record = record or {}
+        record['result'] = result
+        record['finished'] = time.time()
+        if succeeded:
+            self._write(self.path('done', name), record)
+        else:
+            self._write(self.path('failed', name), record)
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        return True
+
+    def result(self, name):
+        """
+        The state ('done' or 'failed') and record of a finished job,
+        or None if it has not finished.
+        """
+        for state in ('done', 'failed'):
+            record = self._read(self.path(state, name))
+            if record is not None:
+                return state, record
+        return None
+
+    def finished(self):
+        """Names of the jobs that are done or failed."""
+        return set(os.path.splitext(x)[0]
+                   for state in ('done', 'failed')
+                   for x in os.listdir(self.path(state))
+                   if x.endswith('.json'))
+
+    def requeueStale(self, timeout):
+        """
+        Return claimed jobs not touched for timeout seconds, e.g.,
+        because their worker died, to pending/.  Returns their names.
+        """
+        names = []
+        now = time.time()
+        for entry in os.listdir(self.path('claimed')):
+            name = os.path.splitext(entry)[0]
+            filename = self.path('claimed', name)
+            try:
+                if now - os.path.getmtime(filename) < timeout:
+                    continue
+                os.rename(filename, self.path('pending', name))
+            except OSError:
+                continue
+            names.append(name)
+        return names
+
+    def close(self):
+        """Tell the workers to exit once there are no pending jobs."""
+        open(os.path.join(self.root, 'closed'), 'w').close()
+
+    def isClosed(self):
+        return os.path.exists(os.path.join(self.root, 'closed'))
+
+    def counts(self):
+        """Number of jobs in each state."""
+        return dict((state, len(os.listdir(self.path(state))))
+                    for state in _states)
+
+def workerName():
+    """Host name and process ID of this worker."""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+def runWorker(queue, handler, poll=1., heartbeat=60., idle_timeout=None,
+              stop=None):
+    """
+    Claim and run jobs until there are no pending jobs and either the
+    queue is closed or the stop event (e.g., a multiprocessing.Event)
+    is set, or until no job has been claimed for idle_timeout seconds.
+    handler is called with each descriptor and returns a pair
+    (succeeded, result), where result is JSON-serializable.  An
+    exception raised by handler fails the job.  Returns the number
+    of jobs run.
+    """
+    worker = workerName()
+    njobs = 0
+    idle = time.time()
+    while True:
+        claimed = queue.claim(worker)
+        if claimed is None:
+            if (queue.isClosed() or (stop is not None and stop.is_set()) or
+                (idle_timeout is not None and
+                 time.time() - idle > idle_timeout)):
+                return njobs
+            time.sleep(poll)
+            continue
+        name, descriptor = claimed
+        # Touch the claimed descriptor so that the job is not
+        # requeued while it runs.
+        done = threading.Event()
+        def beat():
+            while not done.wait(heartbeat):
+                queue.touch(name)
+        thread = threading.Thread(target=beat)
+        thread.daemon = True
+        thread.start()
+        try:
+            succeeded, result = handler(descriptor)
+        except Exception as error:
+            succeeded, result = False, {'error': repr(error)}
+        finally:
+            done.set()
+            thread.join()
+        queue.finish(name, succeeded, result, worker)
+        njobs += 1
+        idle = time.time()
@@ -0,0 +1,233 @@
+"""
+Aim:
+====
+Replace the per-object SED manipulation of getPhosimMag with table
+lookups for large (galaxy) catalogs.
+
+Summary:
+========
+For each SED, the magnitude in every band is tabulated on a regular
+grid of (redshift, internal A_v, internal R_v, galactic A_v), for
+mag_norm = 0 and a fixed galactic R_v.  Since the phoSim normalization
+is applied before any reddening or redshifting, it only adds mag_norm
+to every magnitude and is applied analytically at lookup time.  The
+remaining dependence is interpolated multi-linearly.
+
+When a grid is built, the interpolated magnitudes are compared with
+the exact ones at randomly drawn points inside the grid, and the
+largest difference in each band is stored as error_bound.  An axis
+with a single value is not interpolated; queries must then match that
+value.  A grid for all of the SEDs used in an instance catalog can be
+built with
+
+    python mag_grid.py catalog sed_dir output.npz [--lib libdir]
+"""
+import sys
+import optparse
+import numpy as np
+from utensils import phot
+from utensils import sedlib
+from utensils import throughputs
+
+axis_names = ('redshift', 'internal_Av', 'internal_Rv', 'galactic_Av')
+
+def transformed_photons(sed, bandpass_set, redshift, internal_Av,
+                        internal_Rv, galactic_Av, galactic_Rv=3.1):
+    """
+    Apply the getPhosimMag chain of transformations, for mag_norm = 0,
+    to sed and return wave*flambda on the grid of bandpass_set.
+    """
+    sed = sed.chain().scaled(0., phot.phosim_norm)
+    sed = sed.extincted(internal_Av, internal_Rv).redshifted(redshift)
+    sed = sed.extincted(galactic_Av, galactic_Rv)
+    return sed.photons(bandpass_set.wave)
+
+class MagnitudeGrid(object):
+    """
+    Tabulated magnitudes of a set of SEDs.  mags has shape
+    (n_seds, n_redshift, n_internal_Av, n_internal_Rv, n_galactic_Av,
+    n_bands).
+    """
+    def __init__(self, sed_names, bands, axes, mags, galactic_Rv=3.1,
+                 error_bound=None):
+        self.sed_names = list(sed_names)
+        self.bands = list(bands)
+        self.axes = [np.asarray(axis, dtype=float) for axis in axes]
+        self.mags = np.asarray(mags)
+        self.galactic_Rv = galactic_Rv
+        if error_bound is None:
+            error_bound = np.zeros(len(self.bands))
+        self.error_bound = np.asarray(error_bound)
+        self.sed_index = dict((name, i) for i, name
+                              in enumerate(self.sed_names))
+
+    @classmethod
+    def build(cls, sed_names, library, filters='ugrizy',
+              redshift=np.linspace(0, 3, 61),
+              internal_Av=np.linspace(0, 2, 11), internal_Rv=(3.1,),
+              galactic_Av=np.linspace(0, 1, 6), galactic_Rv=3.1,
+              ncheck=100, seed=1234):
+        """
+        Tabulate the magnitudes of the named SEDs (read from an
+        sedlib.SEDLibrary) in the given filters.
+        """
+        bandpass_set = throughputs.getBandpassSet(filters)
+        axes = [np.asarray(axis, dtype=float) for axis in
+                (redshift, internal_Av, internal_Rv, galactic_Av)]
+        shape = tuple(len(axis) for axis in axes)
+        mags = np.empty((len(sed_names),) + shape + (len(bandpass_set),))
+        for i, name in enumerate(sed_names):
+            sed = library.sed(name)
+            photons = np.empty(shape + (len(bandpass_set.wave),))
+            for index in np.ndindex(*shape):
+                pars = [axis[j] for axis, j in zip(axes, index)]
+                photons[index] = transformed_photons(sed, bandpass_set,
+                                                     galactic_Rv=galactic_Rv,
+                                                     *pars)
+            mags[i] = bandpass_set.magnitudes(
+                photons.reshape(-1, len(bandpass_set.wave))
+                ).reshape(shape + (len(bandpass_set),))
+        grid = cls(sed_names, bandpass_set.names, axes, mags,
+                   galactic_Rv=galactic_Rv)
+        if ncheck > 0:
+            grid.error_bound = grid.check(library, ncheck, seed)
+        return grid
+
+    def check(self, library, ncheck=100, seed=1234):
+        """
+        Largest absolute difference, per band, between interpolated
+        and exact magnitudes at ncheck random points in the grid.
+        """
+        rng = np.random.RandomState(seed)
+        bandpass_set = throughputs.getBandpassSet(self.bands)
+        sed_ids = rng.randint(len(self.sed_names), size=ncheck)
+        pars = np.array([rng.uniform(axis[0], axis[-1], size=ncheck)
+                         for axis in self.axes]).T
+        photons = np.empty((ncheck, len(bandpass_set.wave)))
+        for i in range(ncheck):
+            sed = library.sed(self.sed_names[sed_ids[i]])
+            photons[i] = transformed_photons(sed, bandpass_set,
+                                             galactic_Rv=self.galactic_Rv,
+                                             *pars[i])
+        exact = bandpass_set.magnitudes(photons)
+        interpolated = self._interpolate(sed_ids, pars)
+        diff = np.abs(interpolated - exact)
+        # Infinite magnitudes (no flux in a band) match exactly.
+        diff[np.isinf(exact) & (interpolated == exact)] = 0
+        return diff.max(axis=0)
+
+    def _interpolate(self, sed_ids, pars):
+        npts = len(sed_ids)
+        lower = []
+        fraction = []
+        for name, axis, values in zip(axis_names, self.axes, pars.T):
+            if len(axis) == 1:
+                if np.any(np.abs(values - axis[0]) > 1e-8):
+                    raise ValueError('%s must be %s for this grid'
+                                     % (name, axis[0]))
+                lower.append(np.zeros(npts, dtype=int))
+                fraction.append(np.zeros(npts))
+                continue
+            if np.any(values < axis[0]) or np.any(values > axis[-1]):
+                raise ValueError('%s outside of grid range [%s, %s]'
+                                 % (name, axis[0], axis[-1]))
+            index = np.clip(np.searchsorted(axis, values, side='right') - 1,
+                            0, len(axis) - 2)
+            lower.append(index)
+            fraction.append((values - axis[index])
+                            /(axis[index + 1] - axis[index]))
+        result = np.zeros((npts, len(self.bands)))
+        for corner in np.ndindex(*((2,)*len(self.axes))):
+            weight = np.ones(npts)
+            index = [sed_ids]
+            for offset, axis, low, frac in zip(corner, self.axes, lower,
+                                               fraction):
+                if offset:
+                    weight = weight*frac
+                    index.append(np.minimum(low + 1, len(axis) - 1))
+                else:
+                    weight = weight*(1. - frac)
+                    index.append(low)
+            nonzero = weight > 0
+            if np.any(nonzero):
+                result[nonzero] += (weight[nonzero][:, None]
+                                    *self.mags[tuple(x[nonzero]
+                                                     for x in index)])
+        return result
+
+    def magnitudes(self, sed_names, mag_norm, redshift=0., internal_Av=0.,
+                   internal_Rv=3.1, galactic_Av=0.):
+        """
+        Return the (n_objects x n_bands) magnitudes for per-object SED
+        names and parameters (scalars are broadcast).
+        """
+        if isinstance(sed_names, str):
+            sed_names = [sed_names]
+        sed_ids = np.array([self.sed_index[name] for name in sed_names])
+        columns = np.broadcast_arrays(sed_ids, redshift, internal_Av,
+                                      internal_Rv, galactic_Av)
+        sed_ids = columns[0]
+        pars = np.array(columns[1:], dtype=float).T
+        mags = self._interpolate(sed_ids, pars)
+        return mags + np.reshape(mag_norm, (-1, 1))
+
+    def save(self, filename):
+        np.savez(filename, sed_names=np.array(self.sed_names),
+                 bands=np.array(self.bands), mags=self.mags,
+                 galactic_Rv=self.galactic_Rv, error_bound=self.error_bound,
+                 **dict(zip(axis_names, self.axes)))
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        return cls(list(data['sed_names']), list(data['bands']),
+                   [data[name] for name in axis_names], data['mags'],
+                   galactic_Rv=float(data['galactic_Rv']),
+                   error_bound=data['error_bound'])
+
+def catalogSEDs(catalog):
+    """Sorted list of the SED names used by the objects in a catalog."""
+    sed_names = set()
+    for line in open(catalog):
+        tokens = line.split()
+        if tokens and tokens[0] == 'object':
+            sed_names.add(tokens[5])
+    return sorted(sed_names)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog catalog sed_dir output.npz')
+    parser.add_option('--lib', dest='libdir', default=None,
+                      help='packed SED library written by sedlib.py')
+    parser.add_option('-f', '--filters', dest='filters', default='ugrizy')
+    parser.add_option('--zmax', dest='zmax', default=3., type='float')
+    parser.add_option('--dz', dest='dz', default=0.05, type='float')
+    parser.add_option('--avmax', dest='avmax', default=2., type='float')
+    parser.add_option('--dav', dest='dav', default=0.2, type='float')
+    parser.add_option('--rv', dest='rv', default='3.1',
+                      help='comma-separated internal R_v values')
+    parser.add_option('--galactic-avmax', dest='galactic_avmax', default=1.,
+                      type='float')
+    parser.add_option('--ncheck', dest='ncheck', default=100, type='int')
+    opt, args = parser.parse_args(sys.argv[1:])
+    if len(args) != 3:
+        parser.print_help()
+        sys.exit(1)
+    catalog, sed_dir, outfile = args
+    library = sedlib.SEDLibrary(opt.libdir, sed_dir=sed_dir)
+    sed_names = catalogSEDs(catalog)
+    redshift = np.linspace(0, opt.zmax, int(round(opt.zmax/opt.dz)) + 1)
+    internal_Av = np.linspace(0, opt.avmax, int(round(opt.avmax/opt.dav)) + 1)
+    internal_Rv = [float(x) for x in opt.rv.split(',')]
+    galactic_Av = np.linspace(0, opt.galactic_avmax,
+                              int(round(opt.galactic_avmax/opt.dav)) + 1)
+    grid = MagnitudeGrid.build(sed_names, library, filters=opt.filters,
+                               redshift=redshift, internal_Av=internal_Av,
+                               internal_Rv=internal_Rv,
+                               galactic_Av=galactic_Av, ncheck=opt.ncheck)
+    grid.save(outfile)
+    for band, error in zip(grid.bands, grid.error_bound):
+        sys.stdout.write('%s: max interpolation error %.4f mag\n'
+                         % (band, error))
+
+if __name__ == '__main__':
+    main()
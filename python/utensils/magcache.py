@@ -0,0 +1,80 @@
+"""
+Aim:
+====
+Avoid recomputing the magnitudes of catalog objects that have not
+changed since the last run.
+
+Summary:
+========
+MagnitudeCache is an opt-in, persistent SQLite store of getPhosimMag
+results.  Each magnitude is keyed by a SHA1 digest of the filter
+fingerprint, the SED file path with its modification time and size,
+mag_norm, the redshift and the dust parameters, so editing a catalog
+(or an SED file) only invalidates the affected rows.  Pass a cache to
+getPhosimMag or getPhosimMags:
+
+    cache = MagnitudeCache('mags.sqlite')
+    mags = getPhosimMags(catalog, 'r', sed_dir=sed_dir, cache=cache)
+"""
+import os
+import sqlite3
+import hashlib
+
+class MagnitudeCache(object):
+    """Persistent SQLite cache of object magnitudes."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS mags '
+                                '(key TEXT PRIMARY KEY, mag REAL)')
+        self.connection.commit()
+        self.stamps = dict()
+
+    def sedStamp(self, filename):
+        """
+        Path, modification time and size of an SED file, memoized for
+        the lifetime of the cache object.
+        """
+        filename = os.path.abspath(filename)
+        try:
+            return self.stamps[filename]
+        except KeyError:
+            pass
+        try:
+            stat = os.stat(filename)
+            stamp = '%s:%r:%d' % (filename, stat.st_mtime, stat.st_size)
+        except OSError:
+            stamp = filename
+        self.stamps[filename] = stamp
+        return stamp
+
+    @staticmethod
+    def key(filter_fingerprint, sed_stamp, mag_norm, redshift, internal_Av,
+            internal_Rv, galactic_Av, galactic_Rv):
+        """Cache key for one magnitude."""
+        fields = [filter_fingerprint, sed_stamp]
+        fields.extend(repr(float(x)) for x in
+                      (mag_norm, redshift, internal_Av, internal_Rv,
+                       galactic_Av, galactic_Rv))
+        return hashlib.sha1(' '.join(fields).encode('utf-8')).hexdigest()
+
+    def get(self, keys):
+        """Return a dictionary of the cached magnitudes for keys."""
+        keys = list(keys)
+        found = dict()
+        # Stay below SQLite's limit on the number of host parameters.
+        for i in range(0, len(keys), 500):
+            subset = keys[i:i+500]
+            query = ('SELECT key, mag FROM mags WHERE key IN (%s)'
+                     % ','.join('?'*len(subset)))
+            found.update(self.connection.execute(query, subset))
+        return found
+
+    def put(self, items):
+        """Store (key, magnitude) pairs."""
+        self.connection.executemany('INSERT OR REPLACE INTO mags VALUES (?, ?)',
+                                    [(key, float(mag)) for key, mag in items])
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -17,3 +17,19 @@ def makedir(path, replace=True, query=True):
         else:
             return
     os.makedirs(path)
+
+def openFile(path):
+    """
+    Open a local file (transparently decompressing .gz and .bz2
+    files) or a url for reading.
+    """
+    if path.startswith('http'):
+        import urllib2
+        return urllib2.urlopen(path)
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path)
+    if path.endswith('.bz2'):
+        import bz2
+        return bz2.BZ2File(path)
+    return open(path)
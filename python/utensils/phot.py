@@ -6,10 +6,18 @@ other measures of magnitude.
 
 Summary:
 ========
-
-
+SED and Bandpass wrap a single spectrum and a single filter curve.
+Each Bandpass precomputes its integration weights, with the
+throughput and AB zeropoint folded in, so that a magnitude is a single
+dot product.  SED.chain() records redshifts, extinction and normalization lazily,
+without copying the SED, and evaluates them only at the wavelengths
+of the bandpass being integrated.
+BandpassSet resamples several Bandpasses onto one shared wavelength
+grid so that the magnitudes of many SEDs in all of the bands can be
+computed at once with a single matrix product.
 
 """
+import hashlib
 import numpy as np
 from scipy.integrate import simps
 from scipy.interpolate import interp1d
@@ -34,29 +42,106 @@ class SED(object):
     def scale(self, mag_norm, bandpass):
         current_mag = self.magnitude(bandpass)
         multiplier = 10**(-0.4 * (mag_norm - current_mag))
-        self.flambda *= multiplier
+        # Rebind rather than scale in place: wave and flambda may be
+        # read-only views shared with other SEDs (see sedlib).
+        self.flambda = self.flambda * multiplier
         self.needs_new_interp=True
 
     def apply_redshift(self, redshift):
         ## redshifts the source. 
-        self.wave *= (1.0 + redshift)
-        self.flambda /= (1.0 + redshift) #seems to be necessary for phoSim consistency...
+        self.wave = self.wave * (1.0 + redshift)
+        self.flambda = self.flambda / (1.0 + redshift) #seems to be necessary for phoSim consistency...
         self.interp = interp1d(self.wave, self.wave*self.flambda)
         self.needs_new_interp=True
 
     def apply_extinction(self, A_v, R_v=3.1):
         ## applies the extinction parameters, taken from phoSim input catalog. 
-        wgood = (self.wave > 91) & (self.wave < 6000)
+        # f99 is defined between 910 A and 1/0.167 um
+        wgood = (self.wave > 91) & (self.wave < 5988)
         self.wave=self.wave[wgood]
         self.flambda=self.flambda[wgood]
-        ext = extinction.reddening(self.wave*10, a_v=A_v, r_v=R_v, model='f99')
-        self.flambda /= ext
+        if A_v != 0:
+            ext = 10**(0.4 * A_v * extinction.unit_extinction(self.wave*10,
+                                                              r_v=R_v))
+            self.flambda /= ext
         self.needs_new_interp=True
 
+    def photons(self, wave):
+        """
+        Return wave*flambda at the requested wavelengths, set to zero
+        outside the range covered by the SED.
+        """
+        return np.interp(wave, self.wave, self.wave*self.flambda,
+                         left=0., right=0.)
+
     def magnitude(self, bandpass):
         interp = self.get_interp()
-        flux = simps(bandpass.throughput * interp(bandpass.wave), bandpass.wave)
-        return -2.5 * np.log10(flux) - bandpass.AB_zeropoint()
+        return bandpass.magnitudes(interp(bandpass.wave))
+
+    def chain(self):
+        """Start a lazy, non-mutating SEDChain of transformations."""
+        return SEDChain(self)
+
+class SEDChain(object):
+    """
+    A lazily evaluated chain of scale, extinction and redshift
+    transformations of an SED.  Each method returns a new chain that
+    shares the source SED; the source arrays are never copied or
+    modified.  The chain is only evaluated at the wavelengths that are
+    asked for (e.g. those of a bandpass), so one loaded SED can serve
+    many objects with different redshifts and dust parameters.
+
+    As with SED.apply_extinction, the transformed SED is zero outside
+    the wavelength range of the extinction model.
+    """
+    def __init__(self, sed, transforms=()):
+        self.sed = sed
+        self.transforms = tuple(transforms)
+
+    def __call__(self, wave):
+        return self.photons(wave)
+
+    def scaled(self, mag_norm, bandpass):
+        multiplier = 10**(-0.4 * (mag_norm - self.magnitude(bandpass)))
+        return SEDChain(self.sed, self.transforms + (('scale', multiplier),))
+
+    def redshifted(self, redshift):
+        return SEDChain(self.sed, self.transforms + (('redshift', redshift),))
+
+    def extincted(self, A_v, R_v=3.1):
+        return SEDChain(self.sed, self.transforms + (('extinction', A_v, R_v),))
+
+    def photons(self, wave):
+        """Return wave*flambda of the transformed SED at wave."""
+        # Walk back through the chain, mapping the requested
+        # wavelengths into the frame of each transformation.  A
+        # redshift leaves wave*flambda unchanged at the shifted
+        # wavelength, so it only rescales the wavelengths.
+        frame_wave = np.array(wave, dtype=float)
+        factor = np.ones_like(frame_wave)
+        valid = np.ones(frame_wave.shape, dtype=bool)
+        for transform in reversed(self.transforms):
+            if transform[0] == 'scale':
+                factor *= transform[1]
+            elif transform[0] == 'redshift':
+                frame_wave /= (1.0 + transform[1])
+            elif transform[0] == 'extinction':
+                A_v, R_v = transform[1:]
+                valid &= (frame_wave > 91) & (frame_wave < 5988)
+                if A_v != 0:
+                    unit = extinction.unit_extinction(frame_wave[valid]*10,
+                                                      r_v=R_v)
+                    factor[valid] /= 10**(0.4 * A_v * unit)
+        result = np.zeros_like(frame_wave)
+        result[valid] = factor[valid]*self.sed.photons(frame_wave[valid])
+        return result
+
+    def magnitude(self, bandpass):
+        # Only evaluate the chain where the bandpass transmits.
+        covered = bandpass.throughput > 0
+        photons = np.zeros(len(bandpass.wave))
+        photons[covered] = self.photons(bandpass.wave[covered])
+        return bandpass.magnitudes(photons)
 
 class Bandpass(object):
     def __init__(self, wave, throughput):
@@ -69,6 +154,15 @@ class Bandpass(object):
     def __call__(self, wave):
         return self.interp(wave)
 
+    def fingerprint(self):
+        """SHA1 digest identifying the throughput curve."""
+        if not hasattr(self, '_fingerprint'):
+            sha1 = hashlib.sha1()
+            sha1.update(np.ascontiguousarray(self.wave, dtype=float))
+            sha1.update(np.ascontiguousarray(self.throughput, dtype=float))
+            self._fingerprint = sha1.hexdigest()
+        return self._fingerprint
+
     def AB_zeropoint(self, force_new_zeropoint=False):
         if not (hasattr(self, 'zp') or force_new_zeropoint):
             AB_source = 3631e-23 # 3631 Jy -> erg/s/Hz/cm^2
@@ -80,3 +174,164 @@ class Bandpass(object):
             AB_flux = simps(AB_photons, self.wave)
             self.zp = -2.5 * np.log10(AB_flux)
         return self.zp
+
+    def weights(self):
+        """
+        Simpson integration weights with the throughput and the AB
+        zeropoint folded in, so that the AB magnitude of an SED is
+        -2.5*log10(np.dot(photons, weights)) for photons = wave*flambda
+        sampled on self.wave.  Computed once.
+        """
+        if not hasattr(self, '_weights'):
+            AB_flux = 10**(-0.4 * self.AB_zeropoint())
+            self._weights = simpson_weights(self.wave)*self.throughput/AB_flux
+        return self._weights
+
+    def magnitudes(self, photons):
+        """
+        AB magnitude(s) for wave*flambda sampled on self.wave: a single
+        SED (1D array) or a stack of SEDs (n_seds x n_wave).
+        """
+        return -2.5 * np.log10(np.dot(photons, self.weights()))
+
+    def coarse(self, dwave, tolerance=None):
+        """
+        Return a copy of this bandpass resampled onto a uniform grid
+        with spacing dwave (nm), for fast screening passes.
+
+        The tolerance attribute of the returned Bandpass is the largest
+        magnitude difference from this bandpass found for smooth test
+        spectra (f_nu ~ nu^alpha for -4 <= alpha <= 4, and blackbodies
+        from 3000 to 30000 K).  Spectra with features narrower than
+        dwave, such as emission lines, can differ by more.  If tolerance
+        is given and that difference exceeds it, a ValueError is raised.
+        """
+        nintervals = int(np.ceil((self.redlim - self.bluelim)/dwave))
+        nintervals += nintervals % 2
+        wave = self.bluelim + dwave*np.arange(nintervals + 1)
+        throughput = np.interp(wave, self.wave, self.throughput,
+                               left=0., right=0.)
+        coarse = Bandpass(wave, throughput)
+        error = 0.
+        for fine_photons, coarse_photons in zip(_test_photons(self.wave),
+                                                _test_photons(wave)):
+            error = max(error, abs(self.magnitudes(fine_photons)
+                                   - coarse.magnitudes(coarse_photons)))
+        coarse.tolerance = error
+        if tolerance is not None and error > tolerance:
+            raise ValueError('Resampling to %s nm gives errors up to %.2g mag'
+                             % (dwave, error))
+        return coarse
+
+def _test_photons(wave):
+    """Smooth test spectra (as wave*flambda) used by Bandpass.coarse."""
+    spectra = [wave**(-1. - alpha) for alpha in np.arange(-4, 4.5, 1.)]
+    hc_over_k = 1.4387770e7  # nm K
+    for temperature in (3000., 6000., 10000., 30000.):
+        spectra.append(wave**-4/np.expm1(hc_over_k/wave/temperature))
+    return spectra
+
+# Mock "normalization" filter with delta-response at 500nm, which is
+# effectively how phoSim normalizes its input catalog.
+phosim_norm = Bandpass([499.9, 500, 500.1], [0.0, 1.0, 0.0])
+
+def simpson_weights(x):
+    """
+    Quadrature weights w such that np.dot(w, y) reproduces
+    simps(y, x) (with scipy's default even='avg' treatment of an even
+    number of samples) for any y sampled on the grid x.
+    """
+    x = np.asarray(x, dtype=float)
+    npts = len(x)
+    if npts < 3:
+        raise ValueError('Need at least 3 samples for Simpson weights')
+
+    def _odd(x):
+        # Composite Simpson's rule for (possibly) uneven spacing.
+        w = np.zeros(len(x))
+        h0 = x[1:-1:2] - x[:-2:2]
+        h1 = x[2::2] - x[1:-1:2]
+        hsum = h0 + h1
+        w[:-2:2] += hsum/6.*(2. - h1/h0)
+        w[1:-1:2] += hsum/6.*hsum*hsum/(h0*h1)
+        w[2::2] += hsum/6.*(2. - h0/h1)
+        return w
+
+    if npts % 2 == 1:
+        return _odd(x)
+    # Even number of samples: average Simpson on the first N-1 points
+    # plus a trapezoid for the last interval with Simpson on the last
+    # N-1 points plus a trapezoid for the first interval.
+    w = np.zeros(npts)
+    w[:-1] += 0.5*_odd(x[:-1])
+    w[-2:] += 0.25*(x[-1] - x[-2])
+    w[1:] += 0.5*_odd(x[1:])
+    w[:2] += 0.25*(x[1] - x[0])
+    return w
+
+class BandpassSet(object):
+    """
+    Several Bandpasses resampled onto a shared, uniform wavelength
+    grid.  The throughputs and Simpson weights are folded into a single
+    (n_wave x n_bands) weight matrix, so that the fluxes of a stack of
+    SEDs in every band are given by one matrix product.
+    """
+    def __init__(self, bandpasses, dwave=1.0):
+        """
+        bandpasses: OrderedDict (or list of (name, Bandpass) pairs)
+        dwave:      Spacing of the shared wavelength grid in nm.
+        """
+        if isinstance(bandpasses, dict):
+            bandpasses = list(bandpasses.items())
+        self.names = [name for name, bandpass in bandpasses]
+        self.bandpasses = [bandpass for name, bandpass in bandpasses]
+        bluelim = min(bandpass.bluelim for bandpass in self.bandpasses)
+        redlim = max(bandpass.redlim for bandpass in self.bandpasses)
+        # Use an odd number of samples so that the plain composite
+        # Simpson's rule applies over the whole grid.
+        nintervals = int(np.ceil((redlim - bluelim)/dwave))
+        nintervals += nintervals % 2
+        self.wave = bluelim + dwave*np.arange(nintervals + 1)
+        simpson = simpson_weights(self.wave)
+        self.weights = np.empty((len(self.wave), len(self.bandpasses)))
+        for i, bandpass in enumerate(self.bandpasses):
+            throughput = np.interp(self.wave, bandpass.wave,
+                                   bandpass.throughput, left=0., right=0.)
+            self.weights[:, i] = simpson*throughput
+        AB_source = 3631e-23 # 3631 Jy -> erg/s/Hz/cm^2
+        c = 29979245800.0 # speed of light in cm/s
+        nm_to_cm = 1.0e-7
+        AB_photons = AB_source * c / self.wave / nm_to_cm
+        self.zeropoints = -2.5*np.log10(np.dot(AB_photons, self.weights))
+
+    def __len__(self):
+        return len(self.names)
+
+    def resample(self, seds):
+        """
+        Return the (n_seds x n_wave) array of wave*flambda for a
+        sequence of SEDs evaluated on the shared grid.
+        """
+        photons = np.empty((len(seds), len(self.wave)))
+        for i, sed in enumerate(seds):
+            photons[i] = sed.photons(self.wave)
+        return photons
+
+    def fluxes(self, photons):
+        """
+        Integrated fluxes in each band for an (n_objects x n_wave)
+        array of wave*flambda sampled on the shared grid.
+        """
+        return np.dot(np.atleast_2d(photons), self.weights)
+
+    def magnitudes(self, seds):
+        """
+        Return the (n_objects x n_bands) array of AB magnitudes.  The
+        input is either a sequence of SEDs or an (n_objects x n_wave)
+        array that has already been resampled onto self.wave.
+        """
+        if isinstance(seds, np.ndarray):
+            photons = seds
+        else:
+            photons = self.resample(seds)
+        return -2.5*np.log10(self.fluxes(photons)) - self.zeropoints
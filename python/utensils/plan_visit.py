@@ -0,0 +1,465 @@
+"""
+Aim:
+====
+Predict the photons, run time and memory of every chip of a visit
+before launching it, in order to size the allocation and to catch the
+chips with pathologically bright stars.
+
+Summary:
+========
+The visit is trimmed as faux_sim.py trims it, or the trimmed catalogs
+of an earlier run are read from --trimmed.  The magnitudes of each
+chip's objects in the visit's filter are computed with getPhosimMags.
+Together with the exposure time and the sky brightness, these give
+the number of photons per chip x exposure:
+
+    photons = exptime*area*rate*(sum(10**(-0.4*mag))
+                                 + arcsec2*10**(-0.4*sky))
+
+Here rate is the photon rate of a 0 mag AB source through the filter
+throughput, and arcsec2 is the solid angle of the chip.  The sky
+brightness defaults to the dark-sky values in sky_brightness, and is
+zero if backgroundmode is 0.  A calibration file fitted to earlier
+runs turns the photons into run times, and the source counts into
+memory, with linear models:
+
+    python plan_visit.py estimate instance_catalog -o output_dir \\
+        [--calibration calib.json]
+    python plan_visit.py calibrate calib.json output_dir [...]
+
+estimate writes plan_<obsid>.json to the output directory.  calibrate
+fits those plans against the usage_<obsid>.txt files that faux_sim.py
+writes there after the visits have been simulated.
+"""
+import os
+import sys
+import glob
+import json
+import math
+import optparse
+import numpy as np
+try:
+    from collections import OrderedDict
+except ImportError:
+    from OrderedDict import OrderedDict
+from utensils import faux_sim
+from utensils import throughputs
+from utensils.getPhosimMag import getPhosimMags, magnitudePool
+from utensils.magcache import MagnitudeCache
+
+# Dark-sky brightness (AB mag/arcsec^2) at zenith.
+sky_brightness = {'u': 22.9, 'g': 22.3, 'r': 21.2, 'i': 20.5, 'z': 19.6,
+                  'y': 18.6}
+
+# Effective collecting area of the LSST primary (cm^2).
+collecting_area = 3.24e5
+
+_h = 6.62607e-27        # Planck constant in erg s
+_c = 29979245800.0      # speed of light in cm/s
+
+def photonRate(bandpass):
+    """
+    Photons/s/cm^2 from a 0 mag AB source through a phot.Bandpass.
+    """
+    # AB_zeropoint integrates flambda*wave (erg/s/cm^2 with wave in
+    # nm); the photon energy is h*c/wave.
+    return 10**(-0.4*bandpass.AB_zeropoint())*1e-7/(_h*_c)
+
+def readLayout(instrDir):
+    """
+    Map the chip IDs in focalplanelayout.txt onto their pixel size
+    (microns), numbers of pixels, and device type and value.
+    """
+    layout = OrderedDict()
+    for line in open(os.path.join(instrDir, 'focalplanelayout.txt')):
+        tokens = line.split()
+        if not tokens or tokens[0].startswith('#'):
+            continue
+        layout[tokens[0]] = (float(tokens[3]), int(tokens[4]),
+                             int(tokens[5]), tokens[6], float(tokens[7]))
+    return layout
+
+def visitParams(phosimDir, instanceCatalog, extraCommands='none'):
+    """
+    The parameters of a visit: the phoSim defaults overridden by the
+    instance catalog header and the extra commands.
+    """
+    lines = open(os.path.join(phosimDir, 'default_instcat')).readlines()
+    for line in open(instanceCatalog):
+        tokens = line.split()
+        if tokens and tokens[0] not in ('object', 'includeobj'):
+            lines.append(line)
+    if extraCommands != 'none':
+        lines.extend(line for line in open(extraCommands) if line.split())
+    return faux_sim.parse_params(lines)
+
+def exposureTimes(params, devtype, devvalue):
+    """
+    The exposure times of a chip, as scheduled by faux_sim.py.
+    """
+    if devtype == 'CCD':
+        nexp = params['SIM_NSNAP']
+        return [float(params['SIM_VISTIME'])/nexp]*nexp
+    return [devvalue]*int(params['SIM_VISTIME']/devvalue)
+
+class Calibration(object):
+    """
+    Linear models of the raytrace run time per exposure (seconds, in
+    the number of photons) and memory (MB, in the number of
+    sources), plus the mean e2adc run time per exposure.
+    """
+    def __init__(self, runtime=(0., 0.), memory=(0., 0.), e2adc=0.,
+                 nsamples=0):
+        self.runtime = tuple(runtime)
+        self.memory = tuple(memory)
+        self.e2adc = e2adc
+        self.nsamples = nsamples
+    @classmethod
+    def load(cls, filename):
+        data = json.load(open(filename))
+        return cls(data['runtime'], data['memory'], data['e2adc'],
+                   data['nsamples'])
+    def save(self, filename):
+        output = open(filename, 'w')
+        json.dump({'runtime': self.runtime, 'memory': self.memory,
+                   'e2adc': self.e2adc, 'nsamples': self.nsamples},
+                  output, indent=1, sort_keys=True)
+        output.close()
+    @staticmethod
+    def fitLine(x, y):
+        """
+        Least squares (intercept, slope).  With a single distinct x,
+        the line goes through the origin and the mean.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if len(set(x)) < 2:
+            return 0., (float(y.mean()/x.mean()) if x.mean() else 0.)
+        slope, intercept = np.polyfit(x, y, 1)
+        return float(intercept), float(slope)
+    @classmethod
+    def fit(cls, samples):
+        """
+        Fit to (photons, sources, raytrace seconds, maxrss MB, e2adc
+        seconds) per exposure.
+        """
+        photons, sources, wall, maxrss, e2adc = zip(*samples)
+        e2adc = [x for x in e2adc if x is not None]
+        return cls(cls.fitLine(photons, wall), cls.fitLine(sources, maxrss),
+                   float(np.mean(e2adc)) if e2adc else 0., len(samples))
+    def seconds(self, photons):
+        return max(0., self.runtime[0] + self.runtime[1]*photons) + self.e2adc
+    def megabytes(self, nsources):
+        return max(0., self.memory[0] + self.memory[1]*nsources)
+
+def chipMagnitudes(trimcatalog, band, opt, cache=None, pool=None):
+    """
+    Magnitudes in band of the objects in a trimmed catalog, computed
+    by pool, from magnitudePool, if given.
+    """
+    mags = getPhosimMags(trimcatalog, filters=band, sed_dir=opt.sedDir,
+                         libdir=opt.libdir, processes=opt.numproc,
+                         cache=cache, pool=pool)[band]
+    return mags[np.isfinite(mags)]
+
+def estimate(params, layout, trimmedDir, opt, calibration=None):
+    """
+    Predict the photons, and with a calibration the run time and
+    memory, of each chip x exposure with a trimmed catalog in
+    trimmedDir.  Returns a list of dictionaries, one per chip
+    x exposure.
+    """
+    observationID = str(params['Opsim_obshistid'])
+    band = 'ugrizy'[params['Opsim_filter']]
+    rate = collecting_area*photonRate(throughputs.getBandpass(band))
+    if params.get('backgroundmode', 1) == 0:
+        sky = 0.
+    elif opt.sky_mag is not None:
+        sky = 10**(-0.4*opt.sky_mag)
+    else:
+        sky = 10**(-0.4*sky_brightness[band])
+    sensors = None
+    if opt.sensor != 'all':
+        sensors = set(opt.sensor.split('|'))
+    cache = None
+    if opt.mag_cache is not None:
+        cache = MagnitudeCache(opt.mag_cache)
+    # One set of magnitude workers for all of the chips.
+    pool = None
+    if opt.numproc != 1:
+        pool = magnitudePool(opt.numproc, band, opt.sedDir, opt.libdir)
+    rows = []
+    try:
+        for cid, (pixelsize, nx, ny, devtype, devvalue) in layout.items():
+            trimcatalog = os.path.join(trimmedDir, 'trimcatalog_%s_%s.pars'
+                                       % (observationID, cid))
+            if ((sensors is not None and cid not in sensors) or
+                not os.path.exists(trimcatalog)):
+                continue
+            mags = chipMagnitudes(trimcatalog, band, opt, cache, pool)
+            if len(mags) < params['SIM_MINSOURCE']:
+                continue
+            arcsec2 = nx*ny*(pixelsize/opt.platescale)**2
+            source_flux = np.sum(10**(-0.4*mags))
+            for ex, exptime in enumerate(exposureTimes(params, devtype,
+                                                       devvalue)):
+                row = OrderedDict([('chip', cid), ('exposure', 'E%03d' % ex),
+                                   ('exptime', exptime),
+                                   ('sources', len(mags)),
+                                   ('brightest', float(mags.min())),
+                                   ('source_photons',
+                                    float(exptime*rate*source_flux)),
+                                   ('sky_photons',
+                                    float(exptime*rate*sky*arcsec2))])
+                row['photons'] = row['source_photons'] + row['sky_photons']
+                if calibration is not None:
+                    row['seconds'] = calibration.seconds(row['photons'])
+                    row['megabytes'] = calibration.megabytes(row['sources'])
+                rows.append(row)
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if cache is not None:
+            cache.close()
+    return rows
+
+def flagChips(rows, bright_mag, outlier_factor):
+    """
+    Flag the chips with a source brighter than bright_mag ('bright')
+    or more than outlier_factor times the median photons ('outlier').
+    Returns a dictionary of the flags by chip.
+    """
+    photons = OrderedDict()
+    for row in rows:
+        photons.setdefault(row['chip'], []).append(row['photons'])
+    median = np.median([max(x) for x in photons.values()]) if photons else 0
+    flags = OrderedDict((cid, []) for cid in photons)
+    for row in rows:
+        cid = row['chip']
+        if row['brightest'] < bright_mag and 'bright' not in flags[cid]:
+            flags[cid].append('bright')
+        if (median > 0 and row['photons'] > outlier_factor*median and
+            'outlier' not in flags[cid]):
+            flags[cid].append('outlier')
+    return flags
+
+def report(rows, flags, opt, stream=sys.stdout):
+    """Print the per-chip predictions and the totals."""
+    calibrated = rows and 'seconds' in rows[0]
+    stream.write('%-10s %4s %8s %9s %12s %12s %10s %10s %s\n'
+                 % ('chip', 'exps', 'sources', 'brightest', 'photons/exp',
+                    'sky/exp', 'time/exp[s]', 'mem[MB]', 'flags'))
+    chips = OrderedDict()
+    for row in rows:
+        chips.setdefault(row['chip'], []).append(row)
+    for cid, entries in chips.items():
+        first = entries[0]
+        seconds = megabytes = '-'
+        if calibrated:
+            seconds = '%.1f' % max(x['seconds'] for x in entries)
+            megabytes = '%.0f' % first['megabytes']
+        stream.write('%-10s %4d %8d %9.2f %12.3e %12.3e %10s %10s %s\n'
+                     % (cid, len(entries), first['sources'],
+                        first['brightest'],
+                        max(x['photons'] for x in entries),
+                        max(x['sky_photons'] for x in entries),
+                        seconds, megabytes, ','.join(flags[cid])))
+    stream.write('\n%d chip x exposure jobs, %.3e photons\n'
+                 % (len(rows), sum(x['photons'] for x in rows)))
+    flagged = [cid for cid in flags if flags[cid]]
+    if flagged:
+        stream.write('Flagged chips: %s\n' % ' '.join(flagged))
+    if not rows:
+        stream.write('No chip has at least SIM_MINSOURCE sources: there '
+                     'is nothing to simulate.\n')
+        return
+    if not calibrated:
+        stream.write('No calibration file: run times and memory are '
+                     'not estimated.\n')
+        return
+    core_hours = sum(x['seconds'] for x in rows)/3600.
+    longest = max(x['seconds'] for x in rows)/3600.
+    peak = max(x['megabytes'] for x in rows)
+    stream.write('%.3g core-hours; longest job %.3g hours; peak memory '
+                 '%.0f MB\n' % (core_hours, longest, peak))
+    if opt.cores is not None and opt.hours is not None:
+        nodes = int(math.ceil(core_hours/(opt.cores*opt.hours)))
+        stream.write('%d nodes of %d cores to finish in %.3g hours '
+                     '(%.0f MB per node at peak)\n'
+                     % (nodes, opt.cores, opt.hours, peak*opt.cores))
+        if longest > opt.hours:
+            stream.write('WARNING: the longest job takes more than %.3g '
+                         'hours\n' % opt.hours)
+
+def trimVisit(phosimDir, instanceCatalog, opt):
+    """
+    Trim the visit in the work directory as faux_sim.py does, and
+    return the PhosimFocalplane.
+    """
+    opt.grid = 'no'
+    fp = faux_sim.PhosimFocalplane(phosimDir, opt,
+                                   {'numproc': opt.numproc,
+                                    'trim_group': opt.trim_group})
+    fp.loadInstanceCatalog(instanceCatalog, opt.extraCommands)
+    os.chdir(opt.workDir)
+    fp.writeInputParamsAndCatalogs()
+    fp.trimObjects(opt.sensor)
+    return fp
+
+def removeTrimmed(fp):
+    """Remove the files written by trimVisit."""
+    os.chdir(fp.workDir)
+    for f in (['obs_%s.pars' % fp.observationID,
+               'catlist_%s.pars' % fp.observationID,
+               'objectcatalog_%s.pars' % fp.observationID] +
+              glob.glob('trimcatalog_%s_*.pars' % fp.observationID)):
+        faux_sim.removeFile(f)
+    os.chdir(fp.phosimDir)
+
+def readUsage(filename):
+    """
+    Map (program, chip) onto (runs, wall seconds, maxrss MB) from a
+    usage_<obsid>.txt table.
+    """
+    usage = dict()
+    for line in open(filename).readlines()[1:]:
+        tokens = line.split()
+        if len(tokens) < 7:
+            continue
+        usage[(tokens[0], tokens[1])] = (int(tokens[2]), float(tokens[3]),
+                                         float(tokens[6]))
+    return usage
+
+def calibrationSamples(directory):
+    """
+    Per-exposure (photons, sources, raytrace seconds, maxrss MB, e2adc
+    seconds) of each chip in the plans and usage tables of a
+    faux_sim.py output directory.
+    """
+    samples = []
+    for path in (directory, os.path.join(directory, 'output')):
+        for planfile in sorted(glob.glob(os.path.join(path, 'plan_*.json'))):
+            observationID = os.path.basename(planfile)[5:-5]
+            usagefile = os.path.join(path, 'usage_%s.txt' % observationID)
+            if not os.path.exists(usagefile):
+                sys.stderr.write('No %s for %s\n' % (usagefile, planfile))
+                continue
+            usage = readUsage(usagefile)
+            chips = OrderedDict()
+            for row in json.load(open(planfile))['jobs']:
+                chips.setdefault(row['chip'], []).append(row)
+            for cid, rows in chips.items():
+                if ('raytrace', cid) not in usage:
+                    continue
+                runs, wall, maxrss = usage[('raytrace', cid)]
+                e2adc = None
+                if ('e2adc', cid) in usage:
+                    e2adc_runs, e2adc_wall = usage[('e2adc', cid)][:2]
+                    e2adc = e2adc_wall/e2adc_runs
+                samples.append((np.mean([x['photons'] for x in rows]),
+                                rows[0]['sources'], wall/runs, maxrss, e2adc))
+    return samples
+
+def main():
+    parser = optparse.OptionParser(usage='%prog estimate instance_catalog '
+                                   '[options]\n'
+                                   '       %prog calibrate calib.json '
+                                   'output_dir [output_dir ...]')
+    phosimDir, binDir = faux_sim.phosimDirs()
+    parser.add_option('-c', '--command', dest="extraCommands", default="none")
+    parser.add_option('-p', '--proc', dest="numproc", default=1, type="int")
+    parser.add_option('-o', '--output', dest="output_dir", default='.')
+    parser.add_option('-b', '--bin', dest="binDir", default=binDir)
+    parser.add_option('-d', '--data', dest="dataDir",
+                      default=os.path.join(phosimDir, 'data'))
+    parser.add_option('--sed', dest="sedDir",
+                      default=os.path.join(phosimDir, 'data', 'SEDs'))
+    parser.add_option('--lib', dest='libdir', default=None,
+                      help='packed SED library written by sedlib.py')
+    parser.add_option('--mag-cache', dest='mag_cache', default=None,
+                      help='SQLite magnitude cache (see magcache)')
+    parser.add_option('-s', '--sensor', dest="sensor", default="all")
+    parser.add_option('-i', '--instrument', dest="instrument", default="lsst")
+    parser.add_option('--trim-group', dest="trim_group", default=None,
+                      type="int")
+    parser.add_option('--cache-dir', dest="cache_dir",
+                      default=os.environ.get('PHOSIM_CACHE_DIR', None),
+                      help="faux_sim.py cache directory, in which the "
+                      "trimmed catalogs are kept for the simulation")
+    parser.add_option('--cache-size', dest="cache_size", default=20.,
+                      type="float", help="cache size limit in GB")
+    parser.add_option('--trimmed', dest="trimmed", default=None,
+                      help="directory of existing trimmed catalogs "
+                      "(default: trim the visit)")
+    parser.add_option('--calibration', dest="calibration", default=None,
+                      help="calibration file written by 'calibrate'")
+    parser.add_option('--sky-mag', dest="sky_mag", default=None,
+                      type="float", help="sky brightness in mag/arcsec^2 "
+                      "(default: dark sky in the visit's filter)")
+    parser.add_option('--platescale', dest="platescale", default=50.,
+                      type="float", help="microns per arcsec")
+    parser.add_option('--bright-mag', dest="bright_mag", default=10.,
+                      type="float", help="flag chips with sources brighter "
+                      "than this")
+    parser.add_option('--outlier-factor', dest="outlier_factor", default=10.,
+                      type="float", help="flag chips with more than this "
+                      "times the median photons")
+    parser.add_option('--cores', dest="cores", default=None, type="int",
+                      help="cores per node, for the node count")
+    parser.add_option('--hours', dest="hours", default=None, type="float",
+                      help="target wall time, for the node count")
+    opt, args = parser.parse_args(sys.argv[1:])
+    if len(args) < 2 or args[0] not in ('estimate', 'calibrate'):
+        parser.print_help()
+        sys.exit(1)
+
+    if args[0] == 'calibrate':
+        samples = []
+        for directory in args[2:]:
+            samples.extend(calibrationSamples(directory))
+        if not samples:
+            sys.stderr.write('No plans with usage tables found.\n')
+            sys.exit(1)
+        calibration = Calibration.fit(samples)
+        calibration.save(args[1])
+        sys.stdout.write('%d chips: raytrace %.3g s + %.3g s/photon, '
+                         'e2adc %.3g s; memory %.3g MB + %.3g MB/source\n'
+                         % ((calibration.nsamples,) + calibration.runtime
+                            + (calibration.e2adc,) + calibration.memory))
+        return
+
+    instanceCatalog = os.path.abspath(args[1])
+    if opt.extraCommands != 'none':
+        opt.extraCommands = os.path.abspath(opt.extraCommands)
+    faux_sim.checkPaths(opt, phosimDir)
+    opt.cache_bytes = int(opt.cache_size*1024**3)
+    calibration = None
+    if opt.calibration is not None:
+        calibration = Calibration.load(opt.calibration)
+    params = visitParams(phosimDir, instanceCatalog, opt.extraCommands)
+    layout = readLayout(opt.instrDir)
+    fp = None
+    if opt.trimmed is None:
+        fp = trimVisit(phosimDir, instanceCatalog, opt)
+        trimmedDir = opt.workDir
+    else:
+        trimmedDir = os.path.abspath(opt.trimmed)
+    try:
+        rows = estimate(params, layout, trimmedDir, opt, calibration)
+    finally:
+        if fp is not None:
+            removeTrimmed(fp)
+    flags = flagChips(rows, opt.bright_mag, opt.outlier_factor)
+    report(rows, flags, opt)
+    output = open(os.path.join(opt.outputDir, 'plan_%s.json'
+                               % params['Opsim_obshistid']), 'w')
+    json.dump({'jobs': rows, 'flags': flags}, output, indent=1)
+    output.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""
+Aim:
+====
+Read the phoSim SED files once, and share them between processes.
+
+Summary:
+========
+The instance catalogs refer to thousands of (gzipped) text files under
+starSED/ and galaxySED/.  ingest() converts a whole SED tree, in
+parallel, into a single float64 array stored as a .npy file, with the
+wavelengths in the first row and flambda in the second, plus a text
+index giving the offset and length of each SED:
+
+    python sedlib.py /path/to/data/SEDs /path/to/sedlib
+
+SEDLibrary memory-maps that array, so that every process on a node
+shares the same pages, and builds phot.SED objects directly on
+read-only views of it.  SEDs that are not in the packed library are
+read from the text files under sed_dir and kept in a bounded LRU cache.
+"""
+import os
+import sys
+import optparse
+import tempfile
+import multiprocessing
+import numpy as np
+try:
+    from collections import OrderedDict
+except ImportError:
+    from OrderedDict import OrderedDict
+from utensils import phot
+from utensils.persistence import openFile
+
+def readSED(filename):
+    """Return the wavelength and flambda columns of an SED file."""
+    data = np.genfromtxt(openFile(filename))
+    return data[:, 0], data[:, 1]
+
+def _readSEDs(args):
+    root, relpath = args
+    try:
+        return relpath, readSED(os.path.join(root, relpath))
+    except Exception as eobj:
+        return relpath, eobj
+
+def findSEDs(root, subdirs=('starSED', 'galaxySED')):
+    """Paths of all the SED files under root, relative to root."""
+    relpaths = []
+    for subdir in subdirs:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, subdir)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                relpaths.append(os.path.relpath(os.path.join(dirpath, filename),
+                                                root))
+    return relpaths
+
+def ingest(root, libdir, subdirs=('starSED', 'galaxySED'), processes=None):
+    """
+    Pack all of the SED files under root/subdirs into libdir.  The text
+    files are parsed by a pool of processes; files that cannot be
+    parsed are reported and skipped.
+    """
+    root = os.path.abspath(root)
+    if not os.path.isdir(libdir):
+        os.makedirs(libdir)
+    relpaths = findSEDs(root, subdirs)
+    # Stream the columns into temporary raw files since the total
+    # length is not known until everything has been read.
+    raw_wave = tempfile.TemporaryFile(dir=libdir)
+    raw_flambda = tempfile.TemporaryFile(dir=libdir)
+    index = []
+    offset = 0
+    pool = multiprocessing.Pool(processes)
+    for relpath, result in pool.imap(_readSEDs,
+                                     [(root, x) for x in relpaths],
+                                     chunksize=16):
+        if isinstance(result, Exception):
+            sys.stderr.write('Skipping %s: %s\n' % (relpath, result))
+            continue
+        wave, flambda = result
+        np.asarray(wave, dtype=np.float64).tofile(raw_wave)
+        np.asarray(flambda, dtype=np.float64).tofile(raw_flambda)
+        index.append((relpath, offset, len(wave)))
+        offset += len(wave)
+    pool.close()
+    pool.join()
+
+    data = np.lib.format.open_memmap(os.path.join(libdir, 'seds.npy.tmp'),
+                                     mode='w+', dtype=np.float64,
+                                     shape=(2, offset))
+    for row, raw in enumerate((raw_wave, raw_flambda)):
+        raw.seek(0)
+        if offset > 0:
+            data[row] = np.fromfile(raw, dtype=np.float64, count=offset)
+        raw.close()
+    data.flush()
+    del data
+    os.rename(os.path.join(libdir, 'seds.npy.tmp'),
+              os.path.join(libdir, 'seds.npy'))
+
+    output = open(os.path.join(libdir, 'index.txt'), 'w')
+    output.write('# root %s\n' % root)
+    for relpath, start, length in index:
+        output.write('%s %d %d\n' % (relpath, start, length))
+    output.close()
+    return len(index)
+
+class SEDLibrary(object):
+    """
+    Memory-mapped SED library with an LRU cache for SEDs that are read
+    from the text files.
+    """
+    def __init__(self, libdir=None, sed_dir=None, cache_size=256):
+        """
+        libdir:     Directory written by ingest(), or None to only
+                    read text files.
+        sed_dir:    Root of the SED text files, for SEDs missing from
+                    the packed library.  Defaults to the root the
+                    library was built from.
+        cache_size: Maximum number of text file SEDs kept in memory.
+        """
+        self.index = dict()
+        self.data = None
+        self.root = None
+        if libdir is not None:
+            self.data = np.load(os.path.join(libdir, 'seds.npy'),
+                                mmap_mode='r')
+            for line in open(os.path.join(libdir, 'index.txt')):
+                tokens = line.split()
+                if line.startswith('#'):
+                    if tokens[1] == 'root':
+                        self.root = tokens[2]
+                    continue
+                self.index[tokens[0]] = (int(tokens[1]), int(tokens[2]))
+        if sed_dir is not None:
+            self.root = os.path.abspath(sed_dir)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __contains__(self, name):
+        return self._relpath(name) in self.index
+
+    def _relpath(self, name):
+        if self.root is not None and os.path.isabs(name):
+            relpath = os.path.relpath(name, self.root)
+            if not relpath.startswith('..'):
+                return relpath
+        return name
+
+    def path(self, name):
+        """Path of the text file for an SED."""
+        relpath = self._relpath(name)
+        if self.root is not None and not os.path.isabs(relpath):
+            return os.path.join(self.root, relpath)
+        return relpath
+
+    def get(self, name):
+        """
+        Return read-only (wave, flambda) arrays for an SED given by its
+        path relative to the SED root (as in the instance catalogs) or
+        by its absolute path.
+        """
+        relpath = self._relpath(name)
+        try:
+            start, length = self.index[relpath]
+            return (self.data[0, start:start+length],
+                    self.data[1, start:start+length])
+        except KeyError:
+            pass
+        try:
+            columns = self.cache.pop(relpath)
+        except KeyError:
+            columns = readSED(self.path(name))
+            for column in columns:
+                column.flags.writeable = False
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[relpath] = columns
+        return columns
+
+    def sed(self, name):
+        """Return a new phot.SED that shares the library's arrays."""
+        return phot.SED(*self.get(name))
+
+def main():
+    parser = optparse.OptionParser(usage='%prog sed_dir libdir')
+    parser.add_option('-p', '--proc', dest='processes', default=None,
+                      type='int', help='number of processes')
+    parser.add_option('-s', '--subdirs', dest='subdirs',
+                      default='starSED,galaxySED',
+                      help='comma-separated SED subdirectories to pack')
+    opt, args = parser.parse_args(sys.argv[1:])
+    if len(args) != 2:
+        parser.print_help()
+        sys.exit(1)
+    nseds = ingest(args[0], args[1], subdirs=opt.subdirs.split(','),
+                   processes=opt.processes)
+    sys.stdout.write('Packed %d SEDs into %s\n' % (nseds, args[1]))
+
+if __name__ == '__main__':
+    main()
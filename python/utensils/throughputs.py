@@ -0,0 +1,175 @@
+"""
+Aim:
+====
+Provide the LSST baseline filter throughputs without going back to
+the network for every magnitude.
+
+Summary:
+========
+Throughput curves are kept in a local, content-addressed store: each
+file is saved under the SHA1 digest of its contents, and an index file
+maps filter names onto digests.  The store lives in
+$RECIPES_THROUGHPUT_DIR (default ~/.recipes/throughputs) and can be
+filled offline, e.g. on a machine with network access or from a copy
+of the LSST throughputs package:
+
+    python throughputs.py total_u.dat total_g.dat ... total_y4.dat
+
+getBandpass() parses each curve at most once per process and hands
+back shared phot.Bandpass objects with their AB zeropoint already
+computed.  Baseline curves that are missing from the store are
+downloaded from the LSST trac export and added to it.
+"""
+import os
+import sys
+import shutil
+import numpy as np
+try:
+    from collections import OrderedDict
+except ImportError:
+    from OrderedDict import OrderedDict
+from utensils import phot
+from utensils.filecache import fileDigest
+from utensils.persistence import openFile
+
+baseline_url = 'https://dev.lsstcorp.org/trac/export/29728/sims/throughputs/tags/1.2/baseline/'
+
+baseline_files = OrderedDict([('u', 'total_u.dat'),
+                              ('g', 'total_g.dat'),
+                              ('r', 'total_r.dat'),
+                              ('i', 'total_i.dat'),
+                              ('z', 'total_z.dat'),
+                              ('y', 'total_y4.dat')])
+
+_bandpasses = dict()
+_bandpass_sets = dict()
+
+def storeDir():
+    """Directory holding the local throughput store."""
+    return os.environ.get('RECIPES_THROUGHPUT_DIR',
+                          os.path.join(os.path.expanduser('~'), '.recipes',
+                                       'throughputs'))
+
+def readIndex(store=None):
+    """Return the filter name -> digest mapping of the store."""
+    if store is None:
+        store = storeDir()
+    index = OrderedDict()
+    try:
+        for line in open(os.path.join(store, 'index.txt')):
+            tokens = line.split()
+            if tokens:
+                index[tokens[0]] = tokens[1]
+    except IOError:
+        pass
+    return index
+
+def addFile(filename, name=None, store=None):
+    """
+    Copy a throughput file into the store and register it under
+    name.  By default, the baseline file names (total_r.dat, etc.) are
+    registered under their filter name, other files under their
+    basename.  Returns the digest.
+    """
+    if store is None:
+        store = storeDir()
+    if name is None:
+        basename = os.path.basename(filename)
+        name = basename
+        for filt, baseline_file in baseline_files.items():
+            if basename == baseline_file:
+                name = filt
+    if not os.path.isdir(store):
+        os.makedirs(store)
+    file_digest = fileDigest(filename)
+    target = os.path.join(store, file_digest + '.dat')
+    if not os.path.exists(target):
+        # Copy then rename so that concurrent readers never see a
+        # partially written file.
+        tmpfile = '%s.tmp%d' % (target, os.getpid())
+        shutil.copy(filename, tmpfile)
+        os.rename(tmpfile, target)
+    index = readIndex(store)
+    index[name] = file_digest
+    tmpfile = os.path.join(store, 'index.txt.tmp%d' % os.getpid())
+    output = open(tmpfile, 'w')
+    for key, value in index.items():
+        output.write('%s %s\n' % (key, value))
+    output.close()
+    os.rename(tmpfile, os.path.join(store, 'index.txt'))
+    return file_digest
+
+def fetchBaseline(filter_str, store=None):
+    """Download a baseline throughput curve into the store."""
+    import urllib2
+    import tempfile
+    urlfile = baseline_url + baseline_files[filter_str]
+    sys.stdout.write('reading throughput curve from %s\n' % urlfile)
+    fd, tmpfile = tempfile.mkstemp(suffix='.dat')
+    output = os.fdopen(fd, 'wb')
+    output.write(urllib2.urlopen(urlfile).read())
+    output.close()
+    try:
+        return addFile(tmpfile, name=filter_str, store=store)
+    finally:
+        os.remove(tmpfile)
+
+def storedFile(filter_str, store=None):
+    """
+    Path to the stored throughput file for one of the baseline
+    filters, downloading it first if it is not in the store.
+    """
+    if store is None:
+        store = storeDir()
+    index = readIndex(store)
+    if filter_str not in index:
+        try:
+            fetchBaseline(filter_str, store)
+        except Exception as eobj:
+            raise RuntimeError('%s band throughput is not in %s and could '
+                               'not be downloaded (%s). Fill the store with '
+                               '"python throughputs.py %s".'
+                               % (filter_str, store, eobj,
+                                  baseline_files[filter_str]))
+        index = readIndex(store)
+    return os.path.join(store, index[filter_str] + '.dat')
+
+def getBandpass(filter_str):
+    """
+    Return the shared phot.Bandpass for a baseline filter (one of
+    'ugrizy'), or for a user supplied throughput file or url.
+    """
+    try:
+        return _bandpasses[filter_str]
+    except KeyError:
+        pass
+    if filter_str in baseline_files:
+        file_ = open(storedFile(filter_str))
+    else:
+        file_ = openFile(filter_str)
+    wave, throughput = np.genfromtxt(file_).T
+    bandpass = phot.Bandpass(wave, throughput)
+    bandpass.AB_zeropoint()
+    _bandpasses[filter_str] = bandpass
+    return bandpass
+
+def getBandpasses(filters='ugrizy'):
+    """OrderedDict of the shared Bandpasses for several filters."""
+    return OrderedDict([(filt, getBandpass(filt)) for filt in filters])
+
+def getBandpassSet(filters='ugrizy', dwave=1.0):
+    """Shared phot.BandpassSet for several filters."""
+    key = (tuple(filters), dwave)
+    try:
+        return _bandpass_sets[key]
+    except KeyError:
+        bandpass_set = phot.BandpassSet(getBandpasses(filters), dwave=dwave)
+        _bandpass_sets[key] = bandpass_set
+        return bandpass_set
+
+if __name__ == '__main__':
+    if not sys.argv[1:]:
+        sys.stderr.write('usage: %s throughput_file [...]\n' % sys.argv[0])
+        sys.exit(1)
+    for filename in sys.argv[1:]:
+        sys.stdout.write('%s %s\n' % (addFile(filename), filename))